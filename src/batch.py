@@ -0,0 +1,74 @@
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+import os
+
+# Runs the same processing for many images in a process pool.
+# Only limited number of images is submitted at once, so memory doesn't grow
+# with the number of inputs, and results come back in the input order.
+
+Result = TypeVar("Result")
+
+
+def count_argument(minimum: int) -> Callable[[str], int]:
+    # argparse type of integer that is at least minimum
+    def parse(value: str) -> int:
+        count = int(value)
+        if count < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}, got {count}")
+        return count
+
+    return parse
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--workers",
+        type=count_argument(0),
+        default=1,
+        help="Number of processes for images (0 means number of CPU cores).",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=count_argument(1),
+        help="Max number of images processed at once (default: 2 per worker).",
+    )
+
+
+def workers_count(workers: int) -> int:
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def run_batch(
+    process: Callable[[str], Result],
+    paths: Iterable[str],
+    workers: int = 1,
+    max_in_flight: int | None = None,
+) -> Iterator[Result]:
+    # process must be picklable: module level function or functools.partial of it
+    if workers < 0:
+        raise ValueError(f"Number of workers can't be negative, got {workers}")
+    if max_in_flight is not None and max_in_flight < 1:
+        raise ValueError(f"At least 1 image must be in flight, got {max_in_flight}")
+    workers = workers_count(workers)
+    if workers == 1:
+        for path in paths:
+            yield process(path)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending: Deque[Future] = deque()
+
+        for path in paths:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(pool.submit(process, path))
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
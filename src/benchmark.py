@@ -0,0 +1,279 @@
+import argparse
+import fnmatch
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import PIL
+from PIL import Image
+
+import image_stats
+import lab_1
+import lab_2_refactor
+import lab_3
+import lab_4
+import lab_5
+import lab_6
+import noise
+from sources import directory_images
+from tiles import split
+
+# python3 ./src/benchmark.py run --output ./benchmarks/base.json
+# python3 ./src/benchmark.py run --output ./benchmarks/new.json
+# python3 ./src/benchmark.py compare ./benchmarks/base.json ./benchmarks/new.json
+
+# Times every image operation on synthetic images of fixed sizes and on bundled
+# images. Synthetic images are generated from fixed seed, so runs on different
+# commits measure the same pixels. Every case is run once to warm up, then
+# repeated, median is compared between two result files.
+
+SIZES: Dict[str, Tuple[int, int]] = {
+    "256": (256, 256),
+    "1k": (1024, 1024),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+
+# returns operation to time, preparation is not timed
+Benchmark = Callable[[Image.Image], Callable[[], object]]
+
+
+def rgba(img: Image.Image) -> Image.Image:
+    return img.convert("RGBA")
+
+
+def pixels(img: Image.Image) -> np.ndarray:
+    return np.asarray(img)
+
+
+def noise_benchmark(kind: str, *args) -> Benchmark:
+    def setup(img: Image.Image) -> Callable[[], object]:
+        image = pixels(img)
+        seed = np.random.SeedSequence(0)
+        return lambda: noise.apply_noise(image, noise.Noise(kind, args), seed)
+
+    return setup
+
+
+def cutout_benchmark(img: Image.Image) -> Callable[[], object]:
+    target = rgba(img)
+    mutation = lab_2_refactor.cutout(
+        img.width // 4, img.width * 3 // 4, img.height // 4, img.height * 3 // 4
+    )
+    return lambda: mutation(target)
+
+
+def watermark_benchmark(img: Image.Image) -> Callable[[], object]:
+    target = rgba(img)
+    return lambda: lab_3.watermark(target, "Benchmark", (50, 50), size=64)
+
+
+BENCHMARKS: Dict[str, Benchmark] = {
+    "change_color": lambda img: lambda: lab_1.change_color(
+        img, (128, 128, 128), (255, 0, 0)
+    ),
+    "balance_color": lambda img: lambda: lab_1.balance_color(img, 1.2, 0.9, 1.1),
+    "cutout": cutout_benchmark,
+    "split": lambda img: lambda: [tile.load() for tile in split(img, 2, 2)],
+    "join": lambda img: lambda: lab_3.join(img, img, True),
+    "watermark": watermark_benchmark,
+    "fit_into": lambda img: lambda: lab_3.fit_into(img, 1000, 600),
+    "binarization": lambda img: lambda: lab_4.binarization(img),
+    "brightness_histogram": lambda img: lambda: image_stats.image_stats(img),
+    "sigma_filter": lambda img: lambda: lab_5.sigma_filter(img),
+    "sigma_filter_large": lambda img: lambda: lab_5.sigma_filter(img, 31, 100),
+    "noise_additive": noise_benchmark("additive", 20),
+    "noise_impulse": noise_benchmark("impulse", 0.05),
+    "noise_brightness_dependent": noise_benchmark("brightness_dependent", 30),
+    "noise_coordinate_dependent": noise_benchmark("coordinate_dependent", 30),
+    "apply_filters": lambda img: lambda: lab_6.apply_filters(pixels(img)),
+}
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    # smooth gradients with noise, so filters and encoders see photo-like content
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    gradients = (
+        np.broadcast_to(x, (height, width)),
+        np.broadcast_to(y, (height, width)),
+        (x + y) / 2,
+    )
+
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    for channel, gradient in enumerate(gradients):
+        noisy = rng.standard_normal((height, width), dtype=np.float32)
+        noisy *= 16
+        noisy += gradient
+        pixels[..., channel] = np.clip(noisy, 0, 255)
+    return Image.fromarray(pixels)
+
+
+def measure(operation: Callable[[], object], repeat: int) -> List[float]:
+    operation()
+
+    times: List[float] = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_case(name: str, case: str, img: Image.Image, repeat: int) -> Dict:
+    times = measure(BENCHMARKS[name](img), repeat)
+    median = statistics.median(times)
+    return {
+        "benchmark": name,
+        "case": case,
+        "width": img.width,
+        "height": img.height,
+        "repeat": repeat,
+        "min": min(times),
+        "median": median,
+        "megapixels_per_second": img.width * img.height / 1_000_000 / median,
+    }
+
+
+def environment() -> Dict:
+    return {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run(args: argparse.Namespace):
+    names = [
+        name
+        for name in BENCHMARKS
+        if any(fnmatch.fnmatch(name, pattern) for pattern in args.benchmarks)
+    ]
+
+    cases: List[Tuple[str, Callable[[], Image.Image]]] = [
+        (size, lambda size=size: synthetic_image(*SIZES[size])) for size in args.sizes
+    ]
+    if args.images_dir is not None and os.path.isdir(args.images_dir):
+        cases += [
+            (os.path.basename(path), lambda path=path: Image.open(path).convert("RGB"))
+            for path in directory_images(args.images_dir)
+        ]
+
+    results: List[Dict] = []
+    for case, load in cases:
+        # only one image is held at once, 8K is big
+        img = load()
+        for name in names:
+            result = run_case(name, case, img, args.repeat)
+            results.append(result)
+            print(
+                f"{name:<28}{case:<16}{result['median'] * 1000:>10.2f} ms"
+                f"{result['megapixels_per_second']:>10.2f} MP/s"
+            )
+        del img
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir != "":
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump({"environment": environment(), "results": results}, file, indent=2)
+
+
+def machine(results: Dict) -> Dict:
+    # time of the run is expected to differ
+    return {
+        key: value for key, value in results["environment"].items() if key != "time"
+    }
+
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    base_results = {(r["benchmark"], r["case"]): r for r in base["results"]}
+
+    regressions = 0
+    for result in new["results"]:
+        key = (result["benchmark"], result["case"])
+        if key not in base_results:
+            continue
+
+        ratio = result["median"] / base_results[key]["median"]
+        if ratio > 1 + args.threshold:
+            status = "REGRESSION"
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            status = "faster"
+        else:
+            status = ""
+        print(f"{key[0]:<28}{key[1]:<16}{ratio:>8.2f}x  {status}")
+
+    if machine(base) != machine(new):
+        print("Environments differ, compare results with care")
+    print(f"{regressions} regressions")
+    return 1 if regressions > 0 else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of image operations.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run benchmarks and save results.")
+    run_parser.add_argument(
+        "--output", default="./benchmarks/results.json", help="JSON file for results."
+    )
+    run_parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=["*"],
+        help=f"Names or glob patterns of benchmarks: {', '.join(BENCHMARKS)}.",
+    )
+    run_parser.add_argument(
+        "--sizes",
+        nargs="*",
+        choices=list(SIZES),
+        default=list(SIZES),
+        help="Sizes of synthetic images.",
+    )
+    run_parser.add_argument(
+        "--images_dir",
+        default="./images",
+        help="Directory with real images to benchmark too.",
+    )
+    run_parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of timed runs of every case."
+    )
+
+    compare_parser = commands.add_parser(
+        "compare", help="Compare two results and flag regressions."
+    )
+    compare_parser.add_argument("base", help="Results before change.")
+    compare_parser.add_argument("new", help="Results after change.")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of median reported as regression.",
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+from typing import Tuple
+from PIL import Image
+
+# Plans decoding for the size image is really needed at.
+# JPEG can be decoded at 1/2, 1/4 or 1/8 of its size straight from DCT
+# coefficients (draft mode), which is much faster and takes less memory
+# than decoding the full frame and shrinking it afterwards.
+# Other formats and small reductions are decoded fully.
+
+Size = Tuple[int, int]
+
+
+def fit_size(width: int, height: int, max_width: int, max_height: int) -> Size:
+    width_ratio = max_width / width
+    height_ratio = max_height / height
+
+    if width_ratio < height_ratio:
+        # width difference is bigger
+        return max_width, round(height * width_ratio)
+
+    return round(width * height_ratio), max_height
+
+
+def can_draft(img: Image.Image, size: Size) -> bool:
+    # draft reduces by factor of 2 at least, and only before pixels are loaded
+    return (
+        img.format == "JPEG" and size[0] * 2 <= img.width and size[1] * 2 <= img.height
+    )
+
+
+def plan_decode(img: Image.Image, size: Size) -> Image.Image:
+    # image must be opened but not loaded yet,
+    # decoded image is at least as big as requested size
+    if can_draft(img, size):
+        img.draft(img.mode, size)
+
+    return img
+
+
+def open_fitted(path: str, max_width: int, max_height: int) -> Image.Image:
+    img = Image.open(path)
+    size = fit_size(img.width, img.height, max_width, max_height)
+    img = plan_decode(img, size)
+
+    # reducing gap shrinks by whole factor first, then resamples the rest
+    return img.resize(size, reducing_gap=2.0)
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from PIL import Image
+
+# Raw frames for intermediate images passed between stages of a job.
+# Frame is a .npy file: small header with shape and dtype, then contiguous pixels.
+# Reading memory maps the file, so next stage gets a view of page cache
+# without decoding or copying.
+
+FRAME_EXTENSION = ".npy"
+
+
+def is_frame_path(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() == FRAME_EXTENSION
+
+
+def temp_frame_path(path: str) -> str:
+    dir, name = os.path.split(path)
+    return os.path.join(dir, f".{name}.tmp-{os.getpid()}{FRAME_EXTENSION}")
+
+
+def write_frame(path: str, pixels: np.ndarray) -> str:
+    # written under temporary name, so readers never see half of the frame
+    temp_path = temp_frame_path(path)
+    np.save(temp_path, np.ascontiguousarray(pixels))
+    os.replace(temp_path, path)
+    return path
+
+
+def read_frame(path: str) -> np.ndarray:
+    # read only view, pages are loaded when they are touched
+    return np.load(path, mmap_mode="r")
+
+
+def load_pixels(path: str, mode: str = "RGB") -> np.ndarray:
+    # frames are mapped as they are, other images are decoded
+    if is_frame_path(path):
+        return read_frame(path)
+    return np.array(Image.open(path).convert(mode))
+
+
+def save_pixels(path: str, pixels: np.ndarray) -> str:
+    if is_frame_path(path):
+        return write_frame(path, pixels)
+    Image.fromarray(pixels).save(path)
+    return path
@@ -1,13 +1,12 @@
 from PIL import Image
 import os
 
+import output
+
 
 def filename(path: str):
     return os.path.splitext(os.path.basename(path))[0]
 
 
-def save_img(img: Image.Image, name: str, dir: str):
-    img.save(
-        dir + name + ".png",
-        "PNG",
-    )
+def save_img(img: Image.Image, name: str, dir: str, preset: str = "default") -> str:
+    return output.save(img, os.path.join(dir, name + ".png"), "PNG", preset)
@@ -0,0 +1,163 @@
+from typing import Dict, Iterator, NamedTuple, Tuple
+from PIL import Image
+import numpy as np
+import sys
+
+# Brightness and color statistics of an image computed in one pass over rows,
+# results are plain arrays, so they can be used without plotting.
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+class ImageStats(NamedTuple):
+    # brightness with 0.3, 0.59, 0.11 weights, same as lab_4.calc_brightness
+    brightness_histogram: np.ndarray
+    # same values as img.convert("L")
+    grayscale_histogram: np.ndarray
+    # one histogram per band
+    channel_histograms: np.ndarray
+    mean: float
+    variance: float
+    percentiles: Dict[int, int]
+
+
+def iter_rows(img: Image.Image, chunk_rows: int = 256) -> Iterator[np.ndarray]:
+    # only one chunk of rows is converted to array at a time
+    for top in range(0, img.height, chunk_rows):
+        bottom = min(top + chunk_rows, img.height)
+        yield np.asarray(img.crop((0, top, img.width, bottom)))
+
+
+def brightness(pixels: np.ndarray) -> np.ndarray:
+    if pixels.ndim == 2:
+        return pixels.astype(np.uint8)
+
+    r = pixels[..., 0].astype(np.float64)
+    g = pixels[..., 1].astype(np.float64)
+    b = pixels[..., 2].astype(np.float64)
+    # rint rounds half to even, same as python round
+    return np.rint(0.3 * r + 0.59 * g + 0.11 * b).astype(np.uint8)
+
+
+def grayscale(pixels: np.ndarray) -> np.ndarray:
+    if pixels.ndim == 2:
+        return pixels.astype(np.uint8)
+
+    # fixed point ITU-R 601-2 luma, as Pillow computes it
+    r = pixels[..., 0].astype(np.uint32)
+    g = pixels[..., 1].astype(np.uint32)
+    b = pixels[..., 2].astype(np.uint32)
+    return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+
+def histogram_percentile(histogram: np.ndarray, percent: float) -> int:
+    # smallest value that has at least given percent of values below or equal to it
+    cumulative = np.cumsum(histogram)
+    return int(np.searchsorted(cumulative, cumulative[-1] * percent / 100))
+
+
+def histogram_moments(histogram: np.ndarray) -> Tuple[float, float]:
+    values = np.arange(len(histogram))
+    count = histogram.sum()
+    mean = float(np.dot(histogram, values) / count)
+    variance = float(np.dot(histogram, (values - mean) ** 2) / count)
+    return mean, variance
+
+
+def image_stats(
+    img: Image.Image,
+    chunk_rows: int = 256,
+    percentiles: Tuple[int, ...] = PERCENTILES,
+) -> ImageStats:
+    bands = len(img.getbands())
+    brightness_histogram = np.zeros(256, dtype=np.int64)
+    grayscale_histogram = np.zeros(256, dtype=np.int64)
+    channel_histograms = np.zeros((bands, 256), dtype=np.int64)
+
+    for pixels in iter_rows(img, chunk_rows):
+        brightness_histogram += np.bincount(brightness(pixels).ravel(), minlength=256)
+        grayscale_histogram += np.bincount(grayscale(pixels).ravel(), minlength=256)
+
+        if pixels.ndim == 2:
+            pixels = pixels[..., None]
+        for band in range(bands):
+            channel_histograms[band] += np.bincount(
+                pixels[..., band].ravel(), minlength=256
+            )
+
+    mean, variance = histogram_moments(brightness_histogram)
+
+    return ImageStats(
+        brightness_histogram,
+        grayscale_histogram,
+        channel_histograms,
+        mean,
+        variance,
+        {
+            percent: histogram_percentile(brightness_histogram, percent)
+            for percent in percentiles
+        },
+    )
+
+
+MATRIX_FORMATS = ("text", "csv", "npy", "memmap")
+
+
+def iter_brightness_rows(
+    img: Image.Image, chunk_rows: int = 256
+) -> Iterator[np.ndarray]:
+    for pixels in iter_rows(img, chunk_rows):
+        yield brightness(pixels)
+
+
+def export_brightness_matrix(
+    img: Image.Image,
+    output: str | None = None,
+    format: str = "text",
+    chunk_rows: int = 256,
+):
+    # matrix is written chunk by chunk, so memory doesn't depend on image size,
+    # without output path text formats go to stdout and npy to binary stdout
+    if format == "memmap":
+        if output is None:
+            raise ValueError("Memory mapped brightness matrix needs output path")
+
+        matrix = np.lib.format.open_memmap(
+            output, mode="w+", dtype=np.uint8, shape=(img.height, img.width)
+        )
+        top = 0
+        for rows in iter_brightness_rows(img, chunk_rows):
+            matrix[top : top + len(rows)] = rows
+            top += len(rows)
+        matrix.flush()
+        del matrix
+        return
+
+    if format == "npy":
+        file = open(output, "wb") if output is not None else sys.stdout.buffer
+        try:
+            header = {
+                "descr": np.dtype(np.uint8).str,
+                "fortran_order": False,
+                "shape": (img.height, img.width),
+            }
+            np.lib.format.write_array_header_1_0(file, header)
+            for rows in iter_brightness_rows(img, chunk_rows):
+                file.write(rows.tobytes())
+        finally:
+            if output is not None:
+                file.close()
+        return
+
+    if format not in MATRIX_FORMATS:
+        raise ValueError(f"Unknown brightness matrix format: {format}")
+
+    # text is the same as printing every value with 5.1f
+    value_format, delimiter = ("%5.1f", " ") if format == "text" else ("%d", ",")
+    file = open(output, "w") if output is not None else sys.stdout
+    try:
+        for rows in iter_brightness_rows(img, chunk_rows):
+            np.savetxt(file, rows, fmt=value_format, delimiter=delimiter)
+    finally:
+        if output is not None:
+            file.close()
@@ -1,7 +1,19 @@
 import argparse
+import os
+from functools import partial
 from typing import List, Tuple
 from PIL import Image
-import os
+import numpy as np
+
+from batch import add_batch_arguments, run_batch
+from decode import plan_decode
+from helpers import filename
+from output import add_output_arguments, batch_encoding
+import output
+from point_ops import apply_point_ops, balance
+from profiling import add_profile_arguments, profiling, run_stage, stage
+from result_cache import add_cache_arguments, args_description, cached_outputs
+from sources import unique_names
 
 # Test with all args
 # python3 ./src/lab_1.py ./images/song.png ./images/town.png --new_width 500 --new_height 500 --output_dir ./images/ --old_color 237 125 67 --new_color 0 236 50 --red_balance 1.5 --green_balance 0.8 --blue_balance 1.2 --format JPEG
@@ -13,45 +25,128 @@ def resize(img: Image.Image, new_width: int, new_height: int):
     return img.resize((new_width, new_height))
 
 
-def is_color_match(color_a: Color, color_b: Color, tolerance: int):
-    return all(abs(color_a[i] - color_b[i]) <= tolerance for i in range(3))
+# old color, new color and tolerance
+RecolorRule = Tuple[Color, Color, int]
 
 
-def change_color(img: Image.Image, old_color: Color, new_color: Color):
-    data = img.getdata()
+def recolor(img: Image.Image, rules: List[RecolorRule]) -> Image.Image:
+    if len(rules) == 0:
+        return img
+    if len(rules) > 64:
+        raise ValueError("Recolor supports at most 64 rules in one pass")
+
+    pixels = np.array(img)
+
+    # bit i of the code is set when channel value is close enough to rule i,
+    # so the whole rule set is matched with one lookup table per channel
+    code_type = next(
+        dtype
+        for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+        if np.iinfo(dtype).bits >= len(rules)
+    )
+    values = np.arange(256)
+    tables = np.zeros((3, 256), dtype=code_type)
+    for i, (old_color, _, tolerance) in enumerate(rules):
+        for channel in range(3):
+            matches = np.abs(values - old_color[channel]) <= tolerance
+            tables[channel][matches] |= code_type(1 << i)
+
+    # the only frame sized buffer, codes of matched rules for every pixel
+    codes = np.take(tables[0], pixels[..., 0])
+    codes &= np.take(tables[1], pixels[..., 1])
+    codes &= np.take(tables[2], pixels[..., 2])
+
+    # rules are matched against original colors, first matching rule wins
+    for i, (_, new_color, _) in enumerate(rules):
+        bit = code_type(1 << i)
+        matched = (codes & bit) != 0
+        pixels[matched, :3] = new_color
+        # pixels that matched are done, so later rules don't touch them
+        codes[matched] = 0
+
+    return Image.fromarray(pixels)
 
-    new_data = []
-    for item in data:
-        if is_color_match(item, old_color, 50):
-            new_data.append(new_color)
-        else:
-            new_data.append(item)
 
-    img.putdata(new_data)
-    return img
+def change_color(img: Image.Image, old_color: Color, new_color: Color):
+    return recolor(img, [(old_color, new_color, 50)])
 
 
 def balance_color(
-    red: float = 1.0, green: float = 1.0, blue: float = 1.0
+    img: Image.Image, red: float = 1.0, green: float = 1.0, blue: float = 1.0
 ) -> Image.Image:
-    r, g, b = img.split()
-    r = r.point(lambda i: i * red)
-    g = g.point(lambda i: i * green)
-    b = b.point(lambda i: i * blue)
-    return Image.merge("RGB", (r, g, b))
-
-
-def convert_and_save(img: Image.Image, img_path: str, output_dir: str, format: str):
-    img.save(
-        output_dir
-        + os.path.splitext(os.path.basename(img_path))[0]
-        + "."
-        + format.lower(),
-        format,
+    return apply_point_ops(img, [balance(red, green, blue)])
+
+
+def convert_and_save(
+    img: Image.Image,
+    img_path: str,
+    output_dir: str,
+    format: str,
+    preset: str = "default",
+) -> str:
+    path = os.path.join(output_dir, filename(img_path) + "." + format.lower())
+    return output.save(img, path, format, preset)
+
+
+def transform_image(img_path: str, args: argparse.Namespace) -> str:
+    old_color = tuple(args.old_color) if args.old_color else None
+    new_color = tuple(args.new_color) if args.new_color else None
+
+    # sizes are known from the header, before image is decoded
+    img = Image.open(img_path)
+    resized = (
+        args.new_width if args.new_width is not None else img.width,
+        args.new_height if args.new_height is not None else img.height,
+    )
+    scaled = resized
+    if args.scale:
+        scaled = (round(resized[0] * args.scale), round(resized[1] * args.scale))
+
+    # image is never needed bigger than after the first resize,
+    # without it the scaled size is enough
+    with stage("decode", img.width * img.height):
+        img = plan_decode(
+            img, resized if args.new_width or args.new_height else scaled
+        ).convert("RGB")
+
+    if args.new_width or args.new_height:
+        img = run_stage("resize", resize, img, resized[0], resized[1])
+
+    if old_color or new_color:
+        img = run_stage("change_color", change_color, img, old_color, new_color)
+
+    if args.recolor:
+        rules = [(tuple(rule[0:3]), tuple(rule[3:6]), rule[6]) for rule in args.recolor]
+        img = run_stage("recolor", recolor, img, rules)
+
+    img = run_stage(
+        "balance_color",
+        balance_color,
+        img,
+        args.red_balance,
+        args.green_balance,
+        args.blue_balance,
     )
 
+    if args.scale:
+        img = run_stage("scale", resize, img, scaled[0], scaled[1])
 
-if __name__ == "__main__":
+    return convert_and_save(img, img_path, args.output_dir, args.format, args.preset)
+
+
+def process_image(img_path: str, args: argparse.Namespace) -> List[str]:
+    # the same file with the same flags is copied from cache
+    return cached_outputs(
+        args,
+        img_path,
+        args_description("lab_1", args),
+        filename(img_path),
+        args.output_dir,
+        lambda: [transform_image(img_path, args)],
+    )
+
+
+def main():
     parser = argparse.ArgumentParser(
         description="Process images with resizing, color change, and color balance."
     )
@@ -75,6 +170,14 @@ if __name__ == "__main__":
         "--new_color", type=int, nargs=3, help="New color to apply (RGB format)."
     )
 
+    parser.add_argument(
+        "--recolor",
+        type=int,
+        nargs=7,
+        action="append",
+        help="Replace color in one pass with other rules (old RGB, new RGB, tolerance), can be repeated.",
+    )
+
     parser.add_argument(
         "--red_balance", type=float, default=1.0, help="Red color balance multiplier."
     )
@@ -91,32 +194,25 @@ if __name__ == "__main__":
     parser.add_argument(
         "--format",
         type=str,
-        choices=["PNG", "JPEG", "BMP", "TIFF"],
+        choices=["PNG", "JPEG", "BMP", "TIFF", "WEBP"],
         default="JPEG",
-        help="Output image format (choices: 'PNG', 'JPEG', 'BMP', 'TIFF').",
+        help="Output image format (choices: 'PNG', 'JPEG', 'BMP', 'TIFF', 'WEBP').",
     )
 
-    args = parser.parse_args()
-
-    old_color = tuple(args.old_color) if args.old_color else None
-    new_color = tuple(args.new_color) if args.new_color else None
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
-    for img_path in args.imgs_paths:
-        img = Image.open(img_path).convert("RGB")
-
-        if args.new_width or args.new_height:
-            new_width = args.new_width if args.new_width is not None else img.width
-            new_height = args.new_height if args.new_height is not None else img.height
-            img = resize(img, new_width, new_height)
-
-        if old_color or new_color:
-            img = change_color(img, old_color, new_color)
+    args = parser.parse_args()
 
-        img = balance_color(args.red_balance, args.green_balance, args.blue_balance)
+    process = partial(process_image, args=args)
+    with profiling(args), batch_encoding(args):
+        for _ in run_batch(
+            process, unique_names(args.imgs_paths), args.workers, args.max_in_flight
+        ):
+            pass
 
-        if args.scale:
-            new_width = round(img.width * args.scale)
-            new_height = round(img.height * args.scale)
-            img = resize(img, new_width, new_height)
 
-        convert_and_save(img, img_path, args.output_dir, args.format)
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 import argparse
-from typing import List, Tuple
-from PIL import Image, ImageEnhance, ImageDraw
+
+from PIL import Image, ImageEnhance
 import os
 
+from profiling import add_profile_arguments, profiling, run_stage, stage
+from tiles import split
 
 # python3 ./src/lab_2.py ./images/town.jpg --opacity 0.2 --crop 1000 50 3000 1500 --contrast 1.5 --rows 2 --cols 2 --cutout 1500 100 2200 1300
 
@@ -16,31 +18,6 @@ def opacity(img: Image.Image, value: float) -> Image.Image:
     return img
 
 
-def split(img: Image.Image, cols: int, rows: int) -> List[Image.Image]:
-    tile_width = img.width // cols
-    tile_height = img.height // rows
-
-    cropped_images: List[Image.Image] = []
-
-    for i in range(rows):
-        for j in range(cols):
-            left = j * tile_width
-            upper = i * tile_height
-            right = left + tile_width
-            lower = upper + tile_height
-
-            # Adjust right and lower to not exceed image dimensions
-            right = min(right, img.width)
-            lower = min(lower, img.height)
-
-            # Crop the image
-            box = (left, upper, right, lower)
-            cropped_image = img.crop(box)
-            cropped_images.append(cropped_image)
-
-    return cropped_images
-
-
 def crop(img: Image.Image, left: int, right: int, top: int, bottom: int) -> Image.Image:
     return img.crop((left, top, right, bottom))
 
@@ -81,6 +58,43 @@ def save(img: Image.Image, name: str, dir: str):
     )
 
 
+def process_image(img_path: str, args: argparse.Namespace):
+    img = Image.open(img_path)
+    with stage("decode", img.width * img.height):
+        img = img.convert("RGBA")
+
+    if args.opacity is not None:
+        img = run_stage("opacity", opacity, img, args.opacity)
+
+    # Apply contrast adjustment if specified
+    if args.contrast is not None:
+        img = run_stage("contrast", contrast, img, args.contrast)
+
+    if args.cutout is not None:
+        left, upper, right, lower = args.cutout
+        img = run_stage("cutout", cutout, img, left, right, upper, lower)
+
+    if args.crop is not None:
+        left, upper, right, lower = args.crop
+        img = run_stage("crop", crop, img, left, right, upper, lower)
+
+    if args.rows is not None or args.cols is not None:
+        rows = args.rows if args.rows is not None else 1
+        cols = args.cols if args.cols is not None else 1
+        cropped_images = split(img, rows, cols)
+
+        for i, cropped_img in enumerate(cropped_images):
+            run_stage(
+                "encode",
+                save,
+                cropped_img,
+                f"{filename(img_path)}_{i}",
+                args.output_dir,
+            )
+    else:
+        run_stage("encode", save, img, filename(img_path), args.output_dir)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Process images with resizing, color change, and color balance."
@@ -121,34 +135,12 @@ def main():
         help="Remove pixels inside a specified area. Provide left, upper, right, lower coordinates.",
     )
 
-    args = parser.parse_args()
-    for img_path in args.imgs_paths:
-        img = Image.open(img_path).convert("RGBA")
-
-        if args.opacity is not None:
-            img = opacity(img, args.opacity)
+    add_profile_arguments(parser)
 
-        # Apply contrast adjustment if specified
-        if args.contrast is not None:
-            img = contrast(img, args.contrast)
-
-        if args.cutout is not None:
-            left, upper, right, lower = args.cutout
-            img = cutout(img, left, right, upper, lower)
-
-        if args.crop is not None:
-            left, upper, right, lower = args.crop
-            img = crop(img, left, right, upper, lower)
-
-        if args.rows is not None or args.cols is not None:
-            rows = args.rows if args.rows is not None else 1
-            cols = args.cols if args.cols is not None else 1
-            cropped_images = split(img, rows, cols)
-
-            for i, cropped_img in enumerate(cropped_images):
-                save(cropped_img, f"{filename(img_path)}_{i}", args.output_dir)
-        else:
-            save(img, filename(img_path), args.output_dir)
+    args = parser.parse_args()
+    with profiling(args):
+        for img_path in args.imgs_paths:
+            process_image(img_path, args)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,16 @@
 import argparse
-from typing import List, Callable
-from PIL import Image, ImageEnhance, ImageDraw
-import os
-
+from functools import partial
+from typing import List, Callable, NamedTuple, Tuple
+from PIL import Image, ImageEnhance, ImageDraw, ImageStat
+
+from batch import add_batch_arguments, run_batch
+from helpers import filename, save_img
+from output import add_output_arguments, batch_encoding
+import point_ops
+from profiling import add_profile_arguments, profiling, run_stage, stage
+from result_cache import add_cache_arguments, cached_outputs
+from sources import unique_names
+from tiles import save_tiles
 
 # python3 ./src/lab_2_refactor.py ./images/town.jpg --opacity 0.2 --crop 1000 50 3000 1500 --contrast 1.5 --rows 2 --cols 2 --cutout 1500 100 2200 1300
 
@@ -36,61 +44,331 @@ def crop(left: int, right: int, top: int, bottom: int) -> ImageMutation:
     return mutation
 
 
-def cutout(left: int, right: int, top: int, bottom: int) -> ImageMutation:
+# left, right, top, bottom
+Region = Tuple[int, int, int, int]
+
+Points = Tuple[Tuple[int, int], ...]
+
+
+def cutout_regions(
+    rectangles: List[Region] | None = None,
+    ellipses: List[Region] | None = None,
+    polygons: List[Points] | None = None,
+) -> ImageMutation:
+    # removes pixels inside of all regions at once, only alpha band is touched
+    rectangles = [] if rectangles is None else list(rectangles)
+    ellipses = [] if ellipses is None else list(ellipses)
+    polygons = [] if polygons is None else list(polygons)
+
     def mutation(img: Image.Image):
-        data = img.getdata()
+        alpha = img.getchannel("A")
 
-        new_data = []
-        for y in range(img.height):
-            for x in range(img.width):
-                index = y * img.width + x
-                r, g, b, a = data[index]
+        for left, right, top, bottom in rectangles:
+            if left < right and top < bottom:
+                alpha.paste(0, (left, top, right, bottom))
 
-                if left <= x < right and top <= y < bottom:
-                    new_data.append((r, g, b, 0))
-                else:
-                    new_data.append((r, g, b, a))
+        draw = ImageDraw.Draw(alpha)
+        for left, right, top, bottom in ellipses:
+            if left < right and top < bottom:
+                draw.ellipse((left, top, right - 1, bottom - 1), fill=0)
+        for points in polygons:
+            draw.polygon(list(points), fill=0)
 
-        img.putdata(new_data)
+        img.putalpha(alpha)
         return img
 
     return mutation
 
 
-# not an image mutation, because returns many images
-def split(img: Image.Image, cols: int, rows: int) -> List[Image.Image]:
-    tile_width = img.width // cols
-    tile_height = img.height // rows
+def cutout(left: int, right: int, top: int, bottom: int) -> ImageMutation:
+    return cutout_regions(rectangles=[(left, right, top, bottom)])
+
+
+def cutout_ellipse(left: int, right: int, top: int, bottom: int) -> ImageMutation:
+    return cutout_regions(ellipses=[(left, right, top, bottom)])
+
+
+def cutout_polygon(points: Points) -> ImageMutation:
+    return cutout_regions(polygons=[points])
+
+
+def point(ops: List[point_ops.PointOp]) -> ImageMutation:
+    def mutation(img: Image.Image):
+        return point_ops.apply_point_ops(img, ops)
+
+    return mutation
+
+
+# Mutation described as data, so the whole pipeline can be planned
+# before it runs: crops are moved to the source, cutouts are clipped
+# to the area that survives and point operations are fused.
+class Step(NamedTuple):
+    kind: str
+    args: Tuple
+
+
+STEP_MUTATIONS = {
+    "opacity": opacity,
+    "contrast": contrast,
+    "crop": crop,
+    "cutout": cutout,
+    "cutout_ellipse": cutout_ellipse,
+    "cutout_polygon": cutout_polygon,
+    "cutout_regions": cutout_regions,
+    "point": point,
+}
+
+
+def mutation(step: Step) -> ImageMutation:
+    return STEP_MUTATIONS[step.kind](*step.args)
+
+
+def plan(img: Image.Image, steps: List[Step]) -> List[Step]:
+    # box of the current frame in source coordinates
+    left, top, right, bottom = 0, 0, img.width, img.height
+    # steps that will run after single crop, in source coordinates
+    deferred: List[Step] = []
+    rgb_changed = False
+    # polygon edges are rasterized with float math, moving polygon
+    # can change pixels on its edges, so it must stay where it was drawn
+    has_polygon = False
+
+    for i, step in enumerate(steps):
+        if step.kind == "crop":
+            crop_left, crop_right, crop_top, crop_bottom = step.args
+
+            # crop outside of frame adds empty pixels, following steps
+            # must see them, so the rest of pipeline runs as is
+            inside = (
+                0 <= crop_left <= crop_right <= right - left
+                and 0 <= crop_top <= crop_bottom <= bottom - top
+            )
+            moves_polygon = has_polygon and (crop_left, crop_top) != (0, 0)
+            if not inside or moves_polygon:
+                return planned(img, deferred, left, right, top, bottom) + steps[i:]
+
+            left, top, right, bottom = (
+                left + crop_left,
+                top + crop_top,
+                left + crop_right,
+                top + crop_bottom,
+            )
+
+        elif step.kind == "cutout":
+            cut_left, cut_right, cut_top, cut_bottom = step.args
+            deferred.append(
+                Step(
+                    "cutout",
+                    (
+                        max(cut_left + left, left),
+                        min(cut_right + left, right),
+                        max(cut_top + top, top),
+                        min(cut_bottom + top, bottom),
+                    ),
+                )
+            )
+
+        elif step.kind == "cutout_ellipse":
+            cut_left, cut_right, cut_top, cut_bottom = step.args
+            deferred.append(
+                Step(
+                    "cutout_ellipse",
+                    (
+                        cut_left + left,
+                        cut_right + left,
+                        cut_top + top,
+                        cut_bottom + top,
+                    ),
+                )
+            )
+
+        elif step.kind == "cutout_polygon":
+            (points,) = step.args
+            points = tuple((x + left, y + top) for x, y in points)
+            deferred.append(Step("cutout_polygon", (points,)))
+            has_polygon = True
+
+        elif step.kind == "contrast" and not rgb_changed:
+            # contrast depends on mean of the frame it sees, so it is taken
+            # from the source area now, before frame is cropped further
+            (factor,) = step.args
+            area = img.crop((left, top, right, bottom)).convert("L")
+            mean = int(ImageStat.Stat(area).mean[0] + 0.5)
+            deferred.append(Step("point", ([point_ops.contrast(factor, mean)],)))
+            rgb_changed = True
+
+        elif step.kind == "opacity":
+            (value,) = step.args
+            deferred.append(Step("point", ([point_ops.opacity(value)],)))
+
+        else:
+            return planned(img, deferred, left, right, top, bottom) + steps[i:]
+
+    return planned(img, deferred, left, right, top, bottom)
+
+
+def planned(
+    img: Image.Image,
+    deferred: List[Step],
+    left: int,
+    right: int,
+    top: int,
+    bottom: int,
+) -> List[Step]:
+    steps: List[Step] = []
+    if (left, top, right, bottom) != (0, 0, img.width, img.height):
+        steps.append(Step("crop", (left, right, top, bottom)))
+
+    for step in deferred:
+        if step.kind == "cutout":
+            cut_left, cut_right, cut_top, cut_bottom = step.args
+            # cutouts outside of the final frame are dropped
+            cut_left, cut_right = max(cut_left, left), min(cut_right, right)
+            cut_top, cut_bottom = max(cut_top, top), min(cut_bottom, bottom)
+            if cut_left >= cut_right or cut_top >= cut_bottom:
+                continue
+
+            rectangle = (
+                cut_left - left,
+                cut_right - left,
+                cut_top - top,
+                cut_bottom - top,
+            )
+            add_cutout(steps, rectangles=[rectangle])
+
+        elif step.kind == "cutout_ellipse":
+            cut_left, cut_right, cut_top, cut_bottom = step.args
+            ellipse = (
+                cut_left - left,
+                cut_right - left,
+                cut_top - top,
+                cut_bottom - top,
+            )
+            add_cutout(steps, ellipses=[ellipse])
+
+        elif step.kind == "cutout_polygon":
+            (points,) = step.args
+            points = tuple((x - left, y - top) for x, y in points)
+            add_cutout(steps, polygons=[points])
+
+        elif step.kind == "point" and len(steps) > 0 and steps[-1].kind == "point":
+            # neighbour point operations become one table
+            (ops,) = steps[-1].args
+            steps[-1] = Step("point", (ops + step.args[0],))
+
+        else:
+            steps.append(step)
+
+    return steps
+
+
+def add_cutout(
+    steps: List[Step],
+    rectangles: List[Region] | None = None,
+    ellipses: List[Region] | None = None,
+    polygons: List[Points] | None = None,
+):
+    # neighbour cutouts of any shape are done in one pass over alpha
+    rectangles = [] if rectangles is None else list(rectangles)
+    ellipses = [] if ellipses is None else list(ellipses)
+    polygons = [] if polygons is None else list(polygons)
+    if len(steps) > 0 and steps[-1].kind == "cutout_regions":
+        previous_rectangles, previous_ellipses, previous_polygons = steps[-1].args
+        rectangles = previous_rectangles + rectangles
+        ellipses = previous_ellipses + ellipses
+        polygons = previous_polygons + polygons
+        steps.pop()
 
-    cropped_images: List[Image.Image] = []
+    steps.append(Step("cutout_regions", (rectangles, ellipses, polygons)))
 
-    for i in range(rows):
-        for j in range(cols):
-            left = j * tile_width
-            upper = i * tile_height
-            right = left + tile_width
-            lower = upper + tile_height
 
-            # Adjust right and lower to not exceed image dimensions
-            right = min(right, img.width)
-            lower = min(lower, img.height)
+def run(img: Image.Image, steps: List[Step]) -> Image.Image:
+    # crop planned to the front is done on decoded source,
+    # so only the area that survives is converted and processed
+    if len(steps) > 0 and steps[0].kind == "crop":
+        left, right, top, bottom = steps[0].args
+        if 0 <= left <= right <= img.width and 0 <= top <= bottom <= img.height:
+            img = run_stage("crop", mutation(steps[0]), img)
+            steps = steps[1:]
 
-            # Crop the image
-            box = (left, upper, right, lower)
-            cropped_image = img.crop(box)
-            cropped_images.append(cropped_image)
+    img = run_stage("convert", Image.Image.convert, img, "RGBA")
+    for step in steps:
+        img = run_stage(step.kind, mutation(step), img)
 
-    return cropped_images
+    return img
 
 
-def filename(path: str):
-    return os.path.splitext(os.path.basename(path))[0]
+def build_pipeline(args: argparse.Namespace) -> List[Step]:
+    pipeline: List[Step] = []
 
+    if args.opacity is not None:
+        pipeline.append(Step("opacity", (args.opacity,)))
+
+    if args.contrast is not None:
+        pipeline.append(Step("contrast", (args.contrast,)))
 
-def save(img: Image.Image, name: str, dir: str):
-    img.save(
-        dir + name + ".png",
-        "PNG",
+    for left, upper, right, lower in args.cutout or []:
+        pipeline.append(Step("cutout", (left, right, upper, lower)))
+
+    for left, upper, right, lower in args.cutout_ellipse or []:
+        pipeline.append(Step("cutout_ellipse", (left, right, upper, lower)))
+
+    for coordinates in args.cutout_polygon or []:
+        points = tuple(zip(coordinates[0::2], coordinates[1::2]))
+        pipeline.append(Step("cutout_polygon", (points,)))
+
+    if args.crop is not None:
+        left, upper, right, lower = args.crop
+        pipeline.append(Step("crop", (left, right, upper, lower)))
+
+    return pipeline
+
+
+def transform_image(
+    img_path: str, pipeline: List[Step], args: argparse.Namespace
+) -> List[str]:
+    source = Image.open(img_path)
+    with stage("decode", source.width * source.height):
+        source.load()
+    img = run(source, plan(source, pipeline))
+    # pipeline always makes new image, decoded source isn't needed anymore
+    del source
+
+    if args.rows is not None or args.cols is not None:
+        rows = args.rows if args.rows is not None else 1
+        cols = args.cols if args.cols is not None else 1
+
+        return save_tiles(
+            img,
+            rows,
+            cols,
+            filename(img_path),
+            args.output_dir,
+            args.tile_workers,
+            args.preset,
+        )
+
+    return [save_img(img, filename(img_path), args.output_dir, args.preset)]
+
+
+def process_image(
+    img_path: str, pipeline: List[Step], args: argparse.Namespace
+) -> List[str]:
+    # the same file with the same pipeline is copied from cache
+    description = {
+        "program": "lab_2_refactor",
+        "pipeline": pipeline,
+        "rows": args.rows,
+        "cols": args.cols,
+        "preset": args.preset,
+    }
+    return cached_outputs(
+        args,
+        img_path,
+        description,
+        filename(img_path),
+        args.output_dir,
+        lambda: transform_image(img_path, pipeline, args),
     )
 
 
@@ -131,41 +409,44 @@ def main():
         "--cutout",
         nargs=4,
         type=int,
-        help="Remove pixels inside a specified area. Provide left, upper, right, lower coordinates.",
+        action="append",
+        help="Remove pixels inside a specified area. Provide left, upper, right, lower coordinates. Can be repeated.",
+    )
+    parser.add_argument(
+        "--cutout_ellipse",
+        nargs=4,
+        type=int,
+        action="append",
+        help="Remove pixels inside an ellipse. Provide left, upper, right, lower coordinates of its box. Can be repeated.",
+    )
+    parser.add_argument(
+        "--cutout_polygon",
+        nargs="+",
+        type=int,
+        action="append",
+        help="Remove pixels inside a polygon. Provide x y coordinates of its points. Can be repeated.",
     )
 
-    args = parser.parse_args()
-    mutations_pipeline: List[ImageMutation] = []
-
-    if args.opacity is not None:
-        mutations_pipeline.append(opacity(args.opacity))
-
-    if args.contrast is not None:
-        mutations_pipeline.append(contrast(args.contrast))
-
-    if args.cutout is not None:
-        left, upper, right, lower = args.cutout
-        mutations_pipeline.append(cutout(left, right, upper, lower))
-
-    if args.crop is not None:
-        left, upper, right, lower = args.crop
-        mutations_pipeline.append(crop(left, right, upper, lower))
-
-    for img_path in args.imgs_paths:
-        img = Image.open(img_path).convert("RGBA")
+    parser.add_argument(
+        "--tile_workers",
+        type=int,
+        default=1,
+        help="Number of threads encoding split parts.",
+    )
 
-        for mutation in mutations_pipeline:
-            img = mutation(img)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
-        if args.rows is not None or args.cols is not None:
-            rows = args.rows if args.rows is not None else 1
-            cols = args.cols if args.cols is not None else 1
-            cropped_images = split(img, rows, cols)
+    args = parser.parse_args()
 
-            for i, cropped_img in enumerate(cropped_images):
-                save(cropped_img, f"{filename(img_path)}_{i}", args.output_dir)
-        else:
-            save(img, filename(img_path), args.output_dir)
+    process = partial(process_image, pipeline=build_pipeline(args), args=args)
+    with profiling(args), batch_encoding(args):
+        for _ in run_batch(
+            process, unique_names(args.imgs_paths), args.workers, args.max_in_flight
+        ):
+            pass
 
 
 if __name__ == "__main__":
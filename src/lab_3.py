@@ -1,4 +1,19 @@
-
+import argparse
+from functools import lru_cache, partial
+from typing import Callable, Dict, Iterable, List, Set, Tuple, TypeVar
+import queue
+import threading
+import tkinter as tk
+from PIL import Image, ImageDraw, ImageFont, ImageTk
+
+from batch import add_batch_arguments, run_batch, workers_count
+from decode import fit_size, open_fitted
+from helpers import filename, save_img
+from mosaic import columns_argument, contact_sheet, mosaic
+from output import add_output_arguments, batch_encoding
+from profiling import add_profile_arguments, profiling, run_stage, stage
+from result_cache import add_cache_arguments, cached_outputs
+from sources import expand_paths, unique_names
 
 # python3 ./src/lab_3.py ./images/town.jpg ./images/song.jpg
 
@@ -8,50 +23,39 @@
 
 # python3 ./src/lab_3.py ./images/town.jpg ./images/song.jpg --join 1 0 --join_direction horizontal --watermark_text "By Roman Koshchei" --watermark_position 50 50 --watermark_font_size 264 --watermark_color 255 255 255 --watermark_opacity 200
 
+Slide = TypeVar("Slide")
+
+# output path and source image it was made from without resizing, if there is one
+Output = Tuple[str, str | None]
+
 
 def join(image_1: Image.Image, image_2: Image.Image, is_vertical: bool) -> Image.Image:
-    new_image: Image.Image
-
-    if is_vertical:
-        new_width: int
-        if image_1.width > image_2.width:
-            new_width = image_1.width
-            image_2_height = round(image_2.height * (image_1.width / image_2.width))
-            image_2 = image_2.resize((image_1.width, image_2_height))
-
-        elif image_2.width > image_1.width:
-            new_width = image_2.width
-            image_1_height = round(image_1.height * (image_2.width / image_1.width))
-            image_1 = image_1.resize((image_2.width, image_1_height))
-
-        else:
-            new_width = image_1.width
-
-        new_height = image_1.height + image_2.height
-        new_image = Image.new("RGB", (new_width, new_height))
-        new_image.paste(image_1, (0, 0))
-        new_image.paste(image_2, (0, image_1.height))
-    else:
-        new_height: int
-        if image_1.height > image_2.height:
-            new_height = image_1.height
-            image_2_width = round(image_2.width * (image_1.height / image_2.height))
-            image_2 = image_2.resize((image_2_width, image_1.height))
+    return mosaic([image_1, image_2], "vertical" if is_vertical else "horizontal")
 
-        elif image_2.height > image_1.height:
-            new_height = image_2.height
-            image_1_width = round(image_1.width * (image_2.height / image_1.height))
-            image_1 = image_1.resize((image_1_width, image_2.height))
 
-        else:
-            new_height = image_1.height
+@lru_cache(maxsize=16)
+def watermark_font(size: int) -> ImageFont.ImageFont | ImageFont.FreeTypeFont:
+    return ImageFont.load_default(size)
+
+
+@lru_cache(maxsize=64)
+def watermark_layer(
+    text: str, size: int, color: Tuple[int, int, int], opacity: int
+) -> Tuple[Image.Image, Tuple[int, int]]:
+    # text rendered once into layer as small as its bounding box,
+    # returns the layer and its offset from text position
+    font = watermark_font(size)
+    left, top, right, bottom = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox(
+        (0, 0), text, font=font
+    )
 
-        new_width = image_1.width + image_2.width
-        new_image = Image.new("RGB", (new_width, new_height))
-        new_image.paste(image_1, (0, 0))
-        new_image.paste(image_2, (image_1.width, 0))
+    layer = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(layer)
+    draw.text(
+        (-left, -top), text, font=font, fill=(color[0], color[1], color[2], opacity)
+    )
 
-    return new_image
+    return layer, (left, top)
 
 
 def watermark(
@@ -62,64 +66,126 @@ def watermark(
     color: Tuple[int, int, int] = (255, 255, 255),
     size: int = 30,
 ):
-    img = img.convert("RGBA")
-    font = ImageFont.load_default(size)
+    # input is never changed, RGBA image is copied, others are converted
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    else:
+        img = img.copy()
 
-    text_layer = Image.new("RGBA", img.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(text_layer)
+    layer, (offset_x, offset_y) = watermark_layer(text, size, tuple(color), opacity)
+    x = position[0] + offset_x
+    y = position[1] + offset_y
 
-    draw.text(position, text, font=font, fill=(color[0], color[1], color[2], opacity))
+    # only the part of text that is inside of image is blended
+    left, top = max(x, 0), max(y, 0)
+    right = min(x + layer.width, img.width)
+    bottom = min(y + layer.height, img.height)
+    if left >= right or top >= bottom:
+        return img
 
-    return Image.alpha_composite(img, text_layer)
+    img.alpha_composite(
+        layer, dest=(left, top), source=(left - x, top - y, right - x, bottom - y)
+    )
+    return img
 
 
 def fit_into(img: Image.Image, max_width: int, max_height: int) -> Image.Image:
-    width_ratio = max_width / img.width
-    height_ratio = max_height / img.height
-
-    new_width: int
-    new_height: int
-
-    if width_ratio < height_ratio:
-        # width difference is bigger
-        new_width = max_width
-        new_height = img.height * width_ratio
-    else:
-        new_height = max_height
-        new_width = img.width * height_ratio
-
-    return img.resize((round(new_width), round(new_height)))
+    return img.resize(fit_size(img.width, img.height, max_width, max_height))
 
 
-def slideshow_run(
-    label: tk.Label, imgs: List[Image.Image], stop_event: threading.Event
+def put_frame(frames: queue.Queue, frame: object, stop_event: threading.Event):
+    while not stop_event.is_set():
+        try:
+            frames.put(frame, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def slideshow_prefetch(
+    slides: List[Slide],
+    frames: queue.Queue,
+    stop_event: threading.Event,
+    size: Tuple[int, int],
+    load: Callable[[Slide, int, int], Image.Image],
 ):
-    current_index = 0
-    time = datetime.now()
+    # decodes and scales next frames ahead of time, queue blocks
+    # when it has enough ready frames, so memory stays bounded
+    cached: Dict[int, Image.Image] = {}
+    can_cache = len(slides) <= frames.maxsize
+    failed: Set[int] = set()
 
+    current_index = 0
     while not stop_event.is_set():
-        new_time = datetime.now()
-        if (new_time - time).seconds > 1:
-            time = new_time
-
-            img = imgs[current_index]
-
-            photo = ImageTk.PhotoImage(fit_into(img, 1000, 600))
-            label.config(image=photo)
-            label.image = photo
-
-            current_index = (current_index + 1) % len(imgs)
+        if len(failed) == len(slides):
+            # nothing can be shown, None stops the show loop
+            put_frame(frames, None, stop_event)
+            return
+
+        if current_index not in failed:
+            img = cached.get(current_index)
+            if img is None:
+                try:
+                    img = load(slides[current_index], size[0], size[1])
+                except Exception as error:
+                    # error is reported by the show loop, slide is skipped from now on
+                    failed.add(current_index)
+                    put_frame(frames, (slides[current_index], error), stop_event)
+                    img = None
+                if img is not None and can_cache:
+                    cached[current_index] = img
+
+            if img is not None:
+                put_frame(frames, img, stop_event)
+
+        current_index = (current_index + 1) % len(slides)
+
+
+def slideshow_show(root: tk.Tk, label: tk.Label, frames: queue.Queue, interval: int):
+    try:
+        frame = frames.get_nowait()
+    except queue.Empty:
+        # next frame isn't ready yet, checking again soon
+        root.after(10, slideshow_show, root, label, frames, interval)
+        return
+
+    if frame is None:
+        print("Slideshow stopped, no slide could be loaded")
+        return
+
+    if isinstance(frame, tuple):
+        slide, error = frame
+        print(f"Slide {slide} is skipped, it couldn't be loaded: {error}")
+        root.after(0, slideshow_show, root, label, frames, interval)
+        return
+
+    # Tk objects are touched only from the main thread
+    photo = ImageTk.PhotoImage(frame)
+    label.config(image=photo)
+    label.image = photo
+
+    root.after(interval, slideshow_show, root, label, frames, interval)
 
 
 def slideshow_close(
-    root: tk.Tk, slideshow_thread: threading.Thread, stop_event: threading.Event
+    root: tk.Tk, prefetch_thread: threading.Thread, stop_event: threading.Event
 ):
-    root.quit()
     stop_event.set()
-    slideshow_thread.join()
+    prefetch_thread.join()
+    root.destroy()
+
 
+def slideshow(
+    slides: List[Slide],
+    interval: int = 2000,
+    prefetch: int = 3,
+    size: Tuple[int, int] = (1000, 600),
+    load: Callable[[Slide, int, int], Image.Image] = open_fitted,
+):
+    # slides are image paths by default, load makes frame of slide fitted into size
+    if len(slides) == 0:
+        return
 
-def slideshow(imgs: List[Image.Image]):
     root = tk.Tk()
     root.title("Slide show")
 
@@ -127,28 +193,168 @@ def slideshow(imgs: List[Image.Image]):
     label.pack()
 
     stop_event = threading.Event()
+    frames: queue.Queue = queue.Queue(maxsize=prefetch)
 
-    # Start the slideshow thread
-    slideshow_thread = threading.Thread(
-        target=slideshow_run, args=(label, imgs, stop_event), daemon=True
+    # Start the prefetch thread
+    prefetch_thread = threading.Thread(
+        target=slideshow_prefetch,
+        args=(slides, frames, stop_event, size, load),
+        daemon=True,
     )
-    slideshow_thread.start()
+    prefetch_thread.start()
+
+    # frames are switched by Tk timers, so nothing runs between them
+    root.after(0, slideshow_show, root, label, frames, interval)
 
     # Handle window close
     root.protocol(
-        "WM_DELETE_WINDOW", lambda: slideshow_close(root, slideshow_thread, stop_event)
+        "WM_DELETE_WINDOW", lambda: slideshow_close(root, prefetch_thread, stop_event)
     )
 
     # Start the main event loop
     root.mainloop()
 
 
+def apply_watermark(
+    img: Image.Image, args: argparse.Namespace, scale: float = 1.0
+) -> Image.Image:
+    # scale draws the same watermark on image resized by it
+    if args.watermark_text is None:
+        return img
+
+    return watermark(
+        img,
+        args.watermark_text,
+        tuple(round(coordinate * scale) for coordinate in args.watermark_position),
+        size=max(round(args.watermark_font_size * scale), 1),
+        color=args.watermark_color,
+        opacity=args.watermark_opacity,
+    )
+
+
+def save_result(img: Image.Image, name: str, args: argparse.Namespace) -> str:
+    img = run_stage("watermark", apply_watermark, img, args)
+    return save_img(img, name, args.output_dir, args.preset)
+
+
+def process_image(img_path: str, args: argparse.Namespace) -> Output:
+    # only watermark changes single image, join and contact sheet are made of many
+    description = {
+        "program": "lab_3",
+        "watermark": [
+            args.watermark_text,
+            args.watermark_position,
+            args.watermark_font_size,
+            args.watermark_color,
+            args.watermark_opacity,
+        ],
+        "preset": args.preset,
+    }
+    name = filename(img_path)
+    paths = cached_outputs(
+        args,
+        img_path,
+        description,
+        name,
+        args.output_dir,
+        lambda: [save_result(decode(img_path), name, args)],
+    )
+    return paths[0], img_path
+
+
+def output_preview(
+    output: Output, max_width: int, max_height: int, args: argparse.Namespace
+) -> Image.Image:
+    path, source_path = output
+    if source_path is None:
+        return open_fitted(path, max_width, max_height)
+
+    # output is the source with watermark, so preview is made from the source,
+    # JPEG source is decoded at reduced size, and watermark is drawn at its scale
+    width = Image.open(source_path).width
+    img = open_fitted(source_path, max_width, max_height)
+    return apply_watermark(img, args, img.width / width)
+
+
+def decode(img_path: str) -> Image.Image:
+    img = Image.open(img_path)
+    with stage("decode", img.width * img.height):
+        return img.convert("RGBA")
+
+
+def process_all(args: argparse.Namespace) -> List[Output]:
+    # paths are streamed, images are decoded only while they are processed
+    imgs_paths: Iterable[str] = unique_names(expand_paths(args.imgs_paths))
+
+    sheet: Image.Image | None = None
+    if args.contact_sheet is not None:
+        # all paths are needed for layout, but images are decoded one by one
+        imgs_paths = list(imgs_paths)
+        cell_width, cell_height = args.contact_sheet_cell
+        with stage("contact_sheet"):
+            sheet = contact_sheet(
+                imgs_paths,
+                args.contact_sheet,
+                cell_width,
+                cell_height,
+                workers=workers_count(args.workers),
+            )
+
+    join_paths: Tuple[str, str] | None = None
+    if args.join is not None:
+        # join needs indexes, so paths (but not images) are listed
+        imgs_paths = list(imgs_paths)
+
+        if len(imgs_paths) > 1:
+            index_1, index_2 = args.join
+            if index_1 < 0 or index_1 > len(imgs_paths) - 1:
+                index_1 = 0
+            if index_2 < 0 or index_2 > len(imgs_paths) - 1:
+                index_2 = 1
+
+            join_paths = (imgs_paths[index_1], imgs_paths[index_2])
+            imgs_paths.remove(join_paths[0])
+            imgs_paths.remove(join_paths[1])
+
+    # every image is watermarked and saved by workers, joined image goes last
+    process = partial(process_image, args=args)
+    # everything is written when encoding ends, before slideshow reads it
+    with batch_encoding(args):
+        outputs = list(run_batch(process, imgs_paths, args.workers, args.max_in_flight))
+
+        if join_paths is not None:
+            is_vertical = True
+            if args.join_direction == "horizontal":
+                is_vertical = False
+
+            img_1 = decode(join_paths[0])
+            img_2 = decode(join_paths[1])
+            with stage("join"):
+                img = join(img_1, img_2, is_vertical)
+            del img_1, img_2
+
+            outputs.append((save_result(img, args.join_name, args), None))
+            del img
+
+        if sheet is not None:
+            sheet_path = save_img(
+                sheet, args.contact_sheet_name, args.output_dir, args.preset
+            )
+            outputs.append((sheet_path, None))
+
+    return outputs
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Process images with resizing, color change, and color balance."
     )
 
-    parser.add_argument("imgs_paths", nargs="+", help="Paths to the input images.")
+    parser.add_argument(
+        "imgs_paths",
+        nargs="+",
+        help="Paths to the input images, directories, glob patterns or - to read paths from stdin.",
+    )
     parser.add_argument(
         "--output_dir",
         type=str,
@@ -206,60 +412,36 @@ def main():
         help="Name of file for the joined image",
     )
 
-    args = parser.parse_args()
-
-    imgs_paths = args.imgs_paths
-    imgs: List[Image.Image] = []
-
-    for img_path in imgs_paths:
-        img = Image.open(img_path).convert("RGBA")
-        imgs.append(img)
-
-    if args.join is not None and len(imgs) > 1:
-        index_1, index_2 = args.join
-        if index_1 < 0 or index_1 > len(imgs) - 1:
-            index_1 = 0
-        if index_2 < 0 or index_2 > len(imgs) - 1:
-            index_2 = 1
-
-        is_vertical = True
-        if args.join_direction == "horizontal":
-            is_vertical = False
-
-        img_1 = imgs[index_1]
-        img_2 = imgs[index_2]
-        img_path_1 = imgs_paths[index_1]
-        img_path_2 = imgs_paths[index_2]
-
-        img = join(img_1, img_2, is_vertical)
-
-        imgs.remove(img_1)
-        imgs.remove(img_2)
-        imgs.append(img)
-        imgs_paths.remove(img_path_1)
-        imgs_paths.remove(img_path_2)
-
-        imgs_paths.append(args.join_name)
-
-    result_imgs: List[Image.Image] = []
-
-    for i, img in enumerate(imgs):
+    parser.add_argument(
+        "--contact_sheet",
+        type=columns_argument,
+        metavar="COLS",
+        help="Compose all input images into contact sheet with given number of columns",
+    )
+    parser.add_argument(
+        "--contact_sheet_cell",
+        type=int,
+        nargs=2,
+        default=[256, 256],
+        help="Size (width, height) of one contact sheet cell",
+    )
+    parser.add_argument(
+        "--contact_sheet_name",
+        default="contact_sheet",
+        help="Name of file for the contact sheet",
+    )
 
-        if args.watermark_text is not None:
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
-            img = watermark(
-                img,
-                args.watermark_text,
-                args.watermark_position,
-                size=args.watermark_font_size,
-                color=args.watermark_color,
-                opacity=args.watermark_opacity,
-            )
+    args = parser.parse_args()
 
-        result_imgs.append(img)
-        save_img(img, filename(imgs_paths[i]), args.output_dir)
+    with profiling(args):
+        outputs = process_all(args)
 
-    slideshow(result_imgs)
+    slideshow(outputs, load=partial(output_preview, args=args))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,17 @@
-from PIL import Image, ImageOps
+import argparse
+from PIL import Image
 import matplotlib.pyplot as plt
 import numpy as np
 
+from image_stats import (
+    MATRIX_FORMATS,
+    ImageStats,
+    export_brightness_matrix,
+    image_stats,
+)
+import point_ops
+from profiling import add_profile_arguments, profiling, run_stage
+
 # python3 ./src/lab_4.py
 
 
@@ -22,7 +32,9 @@ def pixel_brightness(pixel: tuple[int, int, int]):
 
 
 def binarization(img: Image.Image, threshold=128) -> Image.Image:
-    return img.convert("L").point(lambda x: 255 if x > threshold else 0, "1")
+    return point_ops.apply_point_ops(
+        img.convert("L"), [point_ops.threshold(threshold)], "1"
+    )
 
 
 def grayscale(img: Image.Image) -> Image.Image:
@@ -30,55 +42,93 @@ def grayscale(img: Image.Image) -> Image.Image:
 
 
 def negative(img: Image.Image) -> Image.Image:
-    return ImageOps.invert(img)
+    return point_ops.apply_point_ops(img, [point_ops.negate()])
+
+
+def plot_histogram(histogram: np.ndarray, color: str, alpha: float):
+    # histogram is already counted, values are used as weights of bins
+    plt.hist(
+        np.arange(256),
+        bins=256,
+        range=(0, 256),
+        weights=histogram,
+        color=color,
+        alpha=alpha,
+    )
 
 
-def display_grayscale_histogram(img: Image.Image):
-    grayscale_image = img.convert("L")
+def display_grayscale_histogram(img: Image.Image, stats: ImageStats | None = None):
+    if stats is None:
+        stats = image_stats(img)
+
     plt.figure(figsize=(10, 5))
-    plt.hist(np.array(grayscale_image).flatten(), bins=256, color="orange", alpha=0.5)
+    plot_histogram(stats.grayscale_histogram, color="orange", alpha=0.5)
     plt.title("Grayscale Image Histogram")
     plt.xlabel("Pixel Value")
     plt.ylabel("Frequency")
 
 
-def display_brightness_histogram(img: Image.Image):
-    brightness_values = []
-    brightness_values = [pixel_brightness(pixel) for pixel in list(img.getdata())]
+def display_brightness_histogram(img: Image.Image, stats: ImageStats | None = None):
+    if stats is None:
+        stats = image_stats(img)
 
     plt.figure(figsize=(10, 5))
-    plt.hist(brightness_values, bins=256, color="gray", alpha=0.7)
+    plot_histogram(stats.brightness_histogram, color="gray", alpha=0.7)
     plt.title("Histogram of Image Brightness")
     plt.xlabel("Brightness")
     plt.ylabel("Frequency")
 
 
-def display_brightness_matrix(image: Image.Image):
-    brightness_matrix = [
-        [pixel_brightness(image.getpixel((x, y))) for x in range(image.width)]
-        for y in range(image.height)
-    ]
-
-    for row in brightness_matrix:
-        print(" ".join(f"{value:5.1f}" for value in row))
+def display_brightness_matrix(
+    image: Image.Image, output: str | None = None, format: str = "text"
+):
+    export_brightness_matrix(image, output, format)
 
 
 def main():
-    img = Image.open("./images/song.jpg").convert("RGB")
-
-    plot_img(img, "Original Color Image")
-
-    display_brightness_matrix(img)
-
-    plot_img(binarization(img))
-
-    plot_img(grayscale(img))
-
-    plot_img(negative(img))
-
-    display_grayscale_histogram(img)
-
-    display_brightness_histogram(img)
+    parser = argparse.ArgumentParser(description="Image brightness and histograms.")
+    parser.add_argument(
+        "img_path", nargs="?", default="./images/song.jpg", help="Path to the image."
+    )
+    parser.add_argument(
+        "--matrix_format",
+        choices=MATRIX_FORMATS,
+        default="text",
+        help="Format of brightness matrix (memmap needs --matrix_output).",
+    )
+    parser.add_argument(
+        "--matrix_output",
+        help="File for brightness matrix (default: stdout).",
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling(args):
+        img = Image.open(args.img_path)
+        img = run_stage("decode", Image.Image.convert, img, "RGB")
+
+        plot_img(img, "Original Color Image")
+
+        run_stage(
+            "brightness_matrix",
+            display_brightness_matrix,
+            img,
+            args.matrix_output,
+            args.matrix_format,
+        )
+
+        plot_img(run_stage("binarization", binarization, img))
+
+        plot_img(run_stage("grayscale", grayscale, img))
+
+        plot_img(run_stage("negative", negative, img))
+
+        # both histograms come from one pass over the image
+        stats = run_stage("image_stats", image_stats, img)
+
+        display_grayscale_histogram(img, stats)
+
+        display_brightness_histogram(img, stats)
 
     plt.show()
 
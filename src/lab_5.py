@@ -1,41 +1,382 @@
+import argparse
+from functools import partial
+from typing import Callable, List, Sequence, Tuple
 from PIL import Image
+import cv2
 import matplotlib.pyplot as plt
 import numpy as np
+import time
+
+from batch import count_argument, workers_count
+from profiling import add_profile_arguments, profiling, run_stage
+from tiled import run_tiled
 
 # variant 13
 # python3 ./src/lab_5.py
+# python3 ./src/lab_5.py --window_size 9 15 --sigma 40 60 80
+# python3 ./src/lab_5.py --adaptive 3 7 15 --min_count 5
+# python3 ./src/lab_5.py --workers 0
+
+BINS = 256
+
+# windows with more pixels are filtered with histograms by default,
+# smaller ones are faster to go through by shifting the band
+HISTOGRAM_AREA = 729
+
+# histogram backend recomputes window halo for every band, so bands are taller
+HISTOGRAM_BAND_HEIGHT = 256
+
+BACKENDS = ("auto", "shift", "histogram")
+
+# size of square or (height, width), window is centered, so even size takes one more pixel
+Window = int | Tuple[int, int]
+
+# one sigma for all channels or one per channel
+Sigma = int | Sequence[int]
+
+# total and count of valid window pixels for rows of the band
+WindowSums = Tuple[np.ndarray, np.ndarray]
+
+
+def window_offsets(window: Window) -> Tuple[int, int]:
+    height, width = (window, window) if isinstance(window, int) else window
+    return height // 2, width // 2
+
+
+def window_area(window: Window) -> int:
+    offset_y, offset_x = window_offsets(window)
+    return (2 * offset_y + 1) * (2 * offset_x + 1)
+
+
+def channel_sigmas(sigma: Sigma, channels: int = 3) -> List[int]:
+    if np.ndim(sigma) == 0:
+        return [int(sigma)] * channels
+
+    sigmas = [int(value) for value in sigma]
+    if len(sigmas) != channels:
+        raise ValueError(f"Expected {channels} sigma values, got {len(sigmas)}")
+    return sigmas
+
+
+def sigma_filter(
+    image: Image.Image,
+    window_size: Window = 3,
+    sigma: Sigma = 200,
+    band_height=128,
+    backend="auto",
+):
+    pixels = sigma_filter_array(
+        np.array(image), window_size, sigma, band_height, backend
+    )
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def adaptive_sigma_filter(
+    image: Image.Image,
+    windows: List[Window],
+    sigma: Sigma = 200,
+    min_count=5,
+    backend="auto",
+):
+    pixels = adaptive_sigma_filter_array(
+        np.array(image), windows, sigma, min_count, backend=backend
+    )
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def sigma_filter_tiled(
+    image: Image.Image,
+    window_size: Window = 3,
+    sigma: Sigma = 200,
+    workers: int | None = None,
+    backend="auto",
+):
+    # same output as sigma_filter, tiles overlap by window offset
+    image_filter = partial(
+        sigma_filter_array, window_size=window_size, sigma=sigma, backend=backend
+    )
+    halo = max(window_offsets(window_size))
+    pixels = run_tiled(image_filter, np.array(image), halo, workers)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def adaptive_sigma_filter_tiled(
+    image: Image.Image,
+    windows: List[Window],
+    sigma: Sigma = 200,
+    min_count=5,
+    workers: int | None = None,
+    backend="auto",
+):
+    # same output as adaptive_sigma_filter, tiles overlap by the largest window offset
+    image_filter = partial(
+        adaptive_sigma_filter_array,
+        windows=windows,
+        sigma=sigma,
+        min_count=min_count,
+        backend=backend,
+    )
+    halo = max(max(window_offsets(window)) for window in windows)
+    pixels = run_tiled(image_filter, np.array(image), halo, workers)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def shift_sums(
+    plane: np.ndarray, offsets: Tuple[int, int], sigma: int, top: int, bottom: int
+) -> WindowSums:
+    offset_y, offset_x = offsets
+    inner_width = plane.shape[1] - 2 * offset_x
+    center = plane[
+        offset_y + top : offset_y + bottom, offset_x : offset_x + inner_width
+    ]
+
+    # sum of the whole window must fit into accumulator
+    area = (2 * offset_y + 1) * (2 * offset_x + 1)
+    accumulator = np.uint16 if area * 255 <= np.iinfo(np.uint16).max else np.uint32
+
+    # count of small window fits into bytes, byte arithmetic is the fastest
+    counter = np.uint8 if area <= np.iinfo(np.uint8).max else accumulator
+
+    total = np.zeros(center.shape, dtype=accumulator)
+    count = np.zeros(center.shape, dtype=counter)
+    diff = np.empty_like(center)
+    mask = np.empty(center.shape, dtype=bool)
+    # the same mask as 0 and 1 bytes, so adding and multiplying don't cast it
+    ones = mask.view(np.uint8)
+    valid = np.empty_like(center)
+
+    # instead of taking window around each pixel, shift the whole band
+    # by every offset inside the window, shifted views don't copy pixels
+    for dy in range(2 * offset_y + 1):
+        for dx in range(2 * offset_x + 1):
+            shifted = plane[top + dy : bottom + dy, dx : dx + inner_width]
+
+            # same unsigned arithmetic as comparing window with center pixel
+            np.subtract(shifted, center, out=diff)
+            np.less_equal(diff, sigma, out=mask)
+
+            count += ones
+            np.multiply(shifted, ones, out=valid)
+            total += valid
+
+    return total, count
+
 
+def query_groups(queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # pixels ordered by bin they query, pixels of bin are order[ends[bin] : ends[bin + 1]],
+    # query -1 stands for empty range and is never gathered
+    shifted = (queries + 1).astype(np.uint16)
+    # stable sort of 16 bit keys is radix sort
+    order = np.argsort(shifted, kind="stable")
+    ends = np.cumsum(np.bincount(shifted, minlength=BINS + 1))
+    return order, ends
 
-def sigma_filter(image: Image.Image, window_size=3, sigma=200):
-    pixels = np.array(image)
 
-    # offset of window
-    offset = window_size // 2
+def histogram_sums(
+    plane: np.ndarray, offsets: Tuple[int, int], sigma: int, top: int, bottom: int
+) -> WindowSums:
+    offset_y, offset_x = offsets
+    width = plane.shape[1]
+    band = plane[top : bottom + 2 * offset_y]
+    center = band[offset_y : band.shape[0] - offset_y, offset_x : width - offset_x]
+    ksize = (2 * offset_x + 1, 2 * offset_y + 1)
+    area = ksize[0] * ksize[1]
+
+    # flat positions of centers inside the band
+    rows = np.arange(offset_y, offset_y + center.shape[0])[:, None] * width
+    positions = (rows + np.arange(offset_x, width - offset_x)).ravel()
+
+    # same values as unsigned difference with center within sigma: range from center
+    # to center + sigma, it wraps around over 255, so it's counted as window pixels
+    # up to (center + sigma) % 256 minus pixels up to center - 1, plus the whole window
+    lower = center.ravel().astype(np.int32) - 1
+    upper = lower + 1 + min(sigma, BINS - 1)
+    wraps = upper >= BINS
+    upper[wraps] -= BINS
+    queries = [(query_groups(query), query) for query in (lower, upper)]
+    gathered = [
+        (np.zeros(len(positions), np.int32), np.zeros(len(positions), np.int32))
+        for _ in queries
+    ]
+
+    # integral histogram: window count of every bin is a box sum of its pixels,
+    # bins are accumulated in order, so at every bin the running sum is number
+    # of window pixels up to it, cost doesn't depend on window size
+    present = np.bincount(band.ravel(), minlength=BINS)
+    equal = np.empty(band.shape, dtype=np.uint8)
+    counts = np.empty(band.shape, dtype=np.int32)
+    below = np.zeros(band.shape, dtype=np.int32)
+    # sum of running counts of previous bins, sum of pixels up to bin
+    # is bin * below - before, so sums don't need their own box filters
+    before = np.zeros(band.shape, dtype=np.int32)
+
+    for value in range(BINS):
+        if present[value] > 0:
+            np.equal(band, value, out=equal)
+            cv2.boxFilter(
+                equal,
+                cv2.CV_32S,
+                ksize,
+                dst=counts,
+                normalize=False,
+                borderType=cv2.BORDER_CONSTANT,
+            )
+            below += counts
+
+        for ((order, ends), _), (count, accumulated) in zip(queries, gathered):
+            group = order[ends[value] : ends[value + 1]]
+            if len(group) > 0:
+                count[group] = below.ravel()[positions[group]]
+                accumulated[group] = before.ravel()[positions[group]]
+
+        before += below
+
+    (lower_count, lower_before), (upper_count, upper_before) = gathered
+    lower_total = lower * lower_count - lower_before
+    upper_total = upper * upper_count - upper_before
+
+    window_total = cv2.boxFilter(
+        band, cv2.CV_32S, ksize, normalize=False, borderType=cv2.BORDER_CONSTANT
+    ).ravel()[positions]
+
+    count = upper_count - lower_count + wraps * area
+    total = upper_total - lower_total + wraps * window_total
+    return total.reshape(center.shape), count.reshape(center.shape)
+
+
+WINDOW_SUMS = {"shift": shift_sums, "histogram": histogram_sums}
+
+
+def fill_window_means(
+    pixels: np.ndarray,
+    window: Window,
+    sigma: Sigma,
+    means: np.ndarray,
+    counts: np.ndarray | None = None,
+    band_height=128,
+    backend="auto",
+):
+    # writes mean of window pixels within sigma from center and their count,
+    # only for pixels covered by a full window
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown sigma filter backend: {backend}")
+    if backend == "auto":
+        backend = "histogram" if window_area(window) > HISTOGRAM_AREA else "shift"
+    window_sums = WINDOW_SUMS[backend]
+    if backend == "histogram":
+        band_height = max(band_height, HISTOGRAM_BAND_HEIGHT)
+
+    offset_y, offset_x = window_offsets(window)
+    height, width = pixels.shape[0], pixels.shape[1]
+    inner_height = height - 2 * offset_y
+    inner_width = width - 2 * offset_x
+    if inner_height <= 0 or inner_width <= 0:
+        return
+
+    region = (slice(offset_y, height - offset_y), slice(offset_x, width - offset_x))
+    inner = means[region]
+
+    # every channel as contiguous plane, so shifted views are cheap to walk
+    planes = np.ascontiguousarray(np.moveaxis(pixels[..., :3], -1, 0))
+
+    for channel, channel_sigma in enumerate(channel_sigmas(sigma)):
+        # if there is no valid pixels then center pixel is kept
+        if channel_sigma < 0:
+            inner[..., channel] = planes[channel][region]
+            if counts is not None:
+                counts[region][..., channel] = 0
+            continue
+
+        # going through bands of rows, so buffers stay small and in cache
+        for top in range(0, inner_height, band_height):
+            bottom = min(top + band_height, inner_height)
+            total, count = window_sums(
+                planes[channel], (offset_y, offset_x), channel_sigma, top, bottom
+            )
+
+            # center is always valid, so count is never zero, floor division
+            # gives the same value as truncating the mean
+            inner[top:bottom, :, channel] = total // count
+            if counts is not None:
+                counts[region][top:bottom, :, channel] = count
+
+
+def sigma_filter_array(
+    pixels: np.ndarray,
+    window_size: Window = 3,
+    sigma: Sigma = 200,
+    band_height=128,
+    backend="auto",
+) -> np.ndarray:
+    # pixels that are not covered by a full window (border) stay zero
+    output_pixels = np.zeros_like(pixels)
+    fill_window_means(
+        pixels, window_size, sigma, output_pixels, None, band_height, backend
+    )
+    return output_pixels
+
+
+def adaptive_sigma_filter_array(
+    pixels: np.ndarray,
+    windows: List[Window],
+    sigma: Sigma = 200,
+    min_count=5,
+    band_height=128,
+    backend="auto",
+) -> np.ndarray:
+    # every pixel takes the smallest window with at least min_count pixels within
+    # sigma, if there is no such window, the largest window that covers the pixel
+    windows = sorted(windows, key=window_area)
+    height, width = pixels.shape[0], pixels.shape[1]
+    shape = (height, width, 3)
+
     output_pixels = np.zeros_like(pixels)
+    means = np.zeros_like(pixels)
+    counts = np.zeros(shape, dtype=np.int32)
+    chosen = np.zeros(shape, dtype=bool)
 
-    # going through each color
-    for channel in range(3):
-        for i in range(offset, pixels.shape[0] - offset):
-            for j in range(offset, pixels.shape[1] - offset):
-                # taking window
-                window = pixels[
-                    i - offset : i + offset + 1, j - offset : j + offset + 1, channel
-                ]
-                center_pixel = pixels[i, j, channel]
+    # number of windows left to try that cover the pixel
+    remaining = np.zeros((height, width), dtype=np.int32)
+    for window in windows:
+        offset_y, offset_x = window_offsets(window)
+        remaining[offset_y : height - offset_y, offset_x : width - offset_x] += 1
 
-                # determine which pixels has difference with center <= sigma
-                mask = np.abs(window - center_pixel) <= sigma
-                # pixels that are valid
-                filtered_values = window[mask]
+    for window in windows:
+        offset_y, offset_x = window_offsets(window)
+        region = (slice(offset_y, height - offset_y), slice(offset_x, width - offset_x))
+        if remaining[region].size == 0:
+            continue
 
-                # if there is valid pixels then avaraging
-                if filtered_values.size > 0:
-                    output_pixels[i, j, channel] = np.mean(filtered_values)
-                else:
-                    output_pixels[i, j, channel] = center_pixel
+        fill_window_means(pixels, window, sigma, means, counts, band_height, backend)
+        remaining[region] -= 1
 
-    output_image = Image.fromarray(output_pixels.astype(np.uint8))
-    return output_image
+        take = ~chosen[region] & (
+            (counts[region] >= min_count) | (remaining[region] == 0)[..., None]
+        )
+        output_pixels[region][..., :3][take] = means[region][..., :3][take]
+        chosen[region] |= take
+
+    return output_pixels
+
+
+def throughput(
+    image: Image.Image, image_filter: Callable[[Image.Image], Image.Image]
+) -> Tuple[Image.Image, float]:
+    # returns filtered image and speed in megapixels per second
+    start = time.perf_counter()
+    output_image = image_filter(image)
+    elapsed = time.perf_counter() - start
+
+    megapixels = image.width * image.height / 1_000_000
+    return output_image, megapixels / max(elapsed, 1e-9)
+
+
+def sigma_filter_throughput(
+    image: Image.Image, window_size: Window = 3, sigma: Sigma = 200
+) -> Tuple[Image.Image, float]:
+    return throughput(
+        image, partial(sigma_filter, window_size=window_size, sigma=sigma)
+    )
 
 
 def plot_img(img: Image.Image, title: str | None = None):
@@ -47,13 +388,93 @@ def plot_img(img: Image.Image, title: str | None = None):
 
 
 def main():
-    img = Image.open("./images/pigs.jpg").convert("RGB")
+    parser = argparse.ArgumentParser(description="Sigma filter.")
+    parser.add_argument(
+        "img_path", nargs="?", default="./images/pigs.jpg", help="Path to the image."
+    )
+    parser.add_argument(
+        "--window_size",
+        nargs="+",
+        type=int,
+        default=[12],
+        help="Size of square window, or height and width.",
+    )
+    parser.add_argument(
+        "--sigma",
+        nargs="+",
+        type=int,
+        default=[100],
+        help="Sigma for all channels, or one per channel.",
+    )
+    parser.add_argument(
+        "--adaptive",
+        nargs="+",
+        type=int,
+        metavar="SIZE",
+        help="Sizes of square windows to choose from for every pixel.",
+    )
+    parser.add_argument(
+        "--min_count",
+        type=int,
+        default=5,
+        help="Pixels within sigma needed to take smaller adaptive window.",
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default="auto")
+    parser.add_argument(
+        "--workers",
+        type=count_argument(0),
+        default=1,
+        help="Number of processes filtering tiles of image (0 means number of CPU cores).",
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    if len(args.window_size) > 2:
+        parser.error("--window_size takes one size or height and width")
+    if len(args.sigma) not in (1, 3):
+        parser.error("--sigma takes one value or one per channel (3)")
+    workers = workers_count(args.workers)
+
+    sigma = args.sigma[0] if len(args.sigma) == 1 else args.sigma
+    if args.adaptive is not None:
+        name = "adaptive " + ", ".join(f"{size}x{size}" for size in args.adaptive)
+        # tiled filter with one worker is the plain full frame filter
+        image_filter = partial(
+            adaptive_sigma_filter_tiled,
+            windows=args.adaptive,
+            sigma=sigma,
+            min_count=args.min_count,
+            workers=workers,
+            backend=args.backend,
+        )
+    else:
+        window_size = (
+            args.window_size[0]
+            if len(args.window_size) == 1
+            else tuple(args.window_size)
+        )
+        height, width = (
+            (window_size, window_size) if isinstance(window_size, int) else window_size
+        )
+        name = f"{height}x{width}"
+        image_filter = partial(
+            sigma_filter_tiled,
+            window_size=window_size,
+            sigma=sigma,
+            workers=workers,
+            backend=args.backend,
+        )
+
+    with profiling(args):
+        img = Image.open(args.img_path)
+        img = run_stage("decode", Image.Image.convert, img, "RGB")
 
-    plot_img(img)
-    # plot_img(sigma_filter(img, sigma=20))
-    # plot_img(sigma_filter(img, sigma=200))
-    # plot_img(sigma_filter(img, sigma=400))
-    plot_img(sigma_filter(img, window_size=12, sigma=100))
+        plot_img(img)
+        # plot_img(sigma_filter(img, sigma=20))
+        # plot_img(sigma_filter(img, sigma=200))
+        # plot_img(sigma_filter(img, sigma=400))
+        filtered, speed = run_stage("sigma_filter", throughput, img, image_filter)
+        print(f"Sigma filter {name}: {speed:.2f} MP/s")
+        plot_img(filtered)
 
     plt.show()
 
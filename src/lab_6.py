@@ -1,123 +1,320 @@
-from typing import List
-from PIL import Image
+import argparse
+import os
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import cv2
-from scipy.ndimage import gaussian_filter, median_filter, generic_filter
+from scipy.ndimage import gaussian_filter, median_filter
+import time
+import tracemalloc
+
+from batch import count_argument, workers_count
+from frames import load_pixels, read_frame, save_pixels, write_frame
+from helpers import filename
+from metrics import compare
+from noise import Noise, noise_variants
+from profiling import add_profile_arguments, pixels_count, profiling, stage
+from tiled import TiledExecutor
+import metrics
+import noise
 
 # python3 ./src/lab_6.py
+# python3 ./src/lab_6.py --workers 0
 
 ImageArray = np.ndarray
 
-def add_additive_noise(image: ImageArray, variance: float) -> ImageArray:
-    noise = np.random.normal(0, variance**0.5, image.shape)
-    noisy_image = np.clip(image + noise, 0, 255).astype(np.uint8)
-    return noisy_image
 
+def default_rng(rng: np.random.Generator | None) -> np.random.Generator:
+    return np.random.default_rng() if rng is None else rng
 
-def add_impulse_noise(
-    image: ImageArray, amount: float = 0.05, salt_vs_pepper: float = 0.5
-) -> ImageArray:
-    noisy_image = np.copy(image)
-    num_salt = int(np.ceil(amount * image.size * salt_vs_pepper))
-    num_pepper = int(np.ceil(amount * image.size * (1 - salt_vs_pepper)))
 
-    # Add salt (white) noise
-    salt_coords = [np.random.randint(0, i - 1, num_salt) for i in image.shape]
-    noisy_image[salt_coords[0], salt_coords[1], :] = 255
+def add_additive_noise(
+    image: ImageArray, variance: float, rng: np.random.Generator | None = None
+) -> ImageArray:
+    return noise.additive(image, default_rng(rng), variance)
 
-    # Add pepper (black) noise
-    pepper_coords = [np.random.randint(0, i - 1, num_pepper) for i in image.shape]
-    noisy_image[pepper_coords[0], pepper_coords[1], :] = 0
 
-    return noisy_image
+def add_impulse_noise(
+    image: ImageArray,
+    amount: float = 0.05,
+    salt_vs_pepper: float = 0.5,
+    rng: np.random.Generator | None = None,
+) -> ImageArray:
+    return noise.impulse(image, default_rng(rng), amount, salt_vs_pepper)
 
 
 def add_brightness_dependent_noise(
-    image: ImageArray, base_variance: float = 30
+    image: ImageArray, base_variance: float = 30, rng: np.random.Generator | None = None
 ) -> ImageArray:
-    brightness = image.mean(axis=2, keepdims=True) / 255.0
-    variance_map = base_variance * brightness
-    noise = np.random.normal(0, variance_map**0.5, image.shape)
-    noisy_image = np.clip(image + noise, 0, 255).astype(np.uint8)
-    return noisy_image
+    return noise.brightness_dependent(image, default_rng(rng), base_variance)
 
 
 def add_coordinate_dependent_noise(
-    image: ImageArray, base_variance: float = 30
+    image: ImageArray, base_variance: float = 30, rng: np.random.Generator | None = None
+) -> ImageArray:
+    return noise.coordinate_dependent(image, default_rng(rng), base_variance)
+
+
+# noisy variants used in main, after the original image
+NOISES: List[Noise] = [
+    Noise("additive", (20,)),
+    Noise("additive", (50,)),
+    Noise("impulse", (0.05,)),
+    Noise("impulse", (0.1,)),
+    Noise("brightness_dependent", (30,)),
+    Noise("brightness_dependent", (60,)),
+    Noise("coordinate_dependent", (30,)),
+    Noise("coordinate_dependent", (60,)),
+]
+
+
+def mean_filter(image_array: ImageArray, size: int = 3) -> ImageArray:
+    # integer box sum with the same border as scipy reflect mode,
+    # floor division gives the same values as truncated np.mean of the window
+    depth = cv2.CV_16U if size * size * 255 <= np.iinfo(np.uint16).max else cv2.CV_32S
+    window_sum = cv2.boxFilter(
+        image_array,
+        depth,
+        (size, size),
+        normalize=False,
+        borderType=cv2.BORDER_REFLECT,
+    )
+    return (window_sum // (size * size)).astype(np.uint8)
+
+
+def gaussian(image_array: ImageArray, sigma: float = 1) -> ImageArray:
+    return gaussian_filter(image_array, sigma=sigma)
+
+
+def median(image_array: ImageArray, size: int = 3) -> ImageArray:
+    return median_filter(image_array, size=size)
+
+
+def bilateral(
+    image_array: ImageArray,
+    d: int = 9,
+    sigma_color: float = 75,
+    sigma_space: float = 75,
 ) -> ImageArray:
-    rows, cols, _ = image.shape
-    x, y = np.meshgrid(np.linspace(0, 1, cols), np.linspace(0, 1, rows))
-    variance_map = base_variance * (x + y) / 2
-    noise = np.random.normal(0, variance_map[..., None] ** 0.5, image.shape)
-    noisy_image = np.clip(image + noise, 0, 255).astype(np.uint8)
-    return noisy_image
-
-
-def apply_filters(image_array: ImageArray) -> List[ImageArray]:
-    return [
-        # Linear Filters
-        generic_filter(image_array, np.mean, size=(3, 3, 1)),  # Mean Filter
-        gaussian_filter(image_array, sigma=1),  # Gaussian Filter
-        median_filter(image_array, size=3),  # Median Filter
-        # Nonlinear Filters
-        cv2.bilateralFilter(
-            image_array, d=9, sigmaColor=75, sigmaSpace=75
-        ),  # Bilateral Filter
-        cv2.GaussianBlur(image_array, (5, 5), 0),  # Gaussian Mixture Model Filter
-        cv2.morphologyEx(
-            image_array, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8)
-        ),  # Morphological Opening
-        cv2.morphologyEx(
-            image_array, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8)
-        ),  # Morphological Closing
-        cv2.dilate(
-            image_array, np.ones((5, 5), np.uint8), iterations=1
-        ),  # Morphological Dilation
-        cv2.erode(
-            image_array, np.ones((5, 5), np.uint8), iterations=1
-        ),  # Morphological Erosion
-    ]
+    return cv2.bilateralFilter(
+        image_array, d=d, sigmaColor=sigma_color, sigmaSpace=sigma_space
+    )
+
+
+def gaussian_blur(image_array: ImageArray, size: int = 5) -> ImageArray:
+    return cv2.GaussianBlur(image_array, (size, size), 0)
+
+
+def opening(image_array: ImageArray, size: int = 5) -> ImageArray:
+    kernel = np.ones((size, size), np.uint8)
+    return cv2.morphologyEx(image_array, cv2.MORPH_OPEN, kernel)
+
+
+def closing(image_array: ImageArray, size: int = 5) -> ImageArray:
+    kernel = np.ones((size, size), np.uint8)
+    return cv2.morphologyEx(image_array, cv2.MORPH_CLOSE, kernel)
+
+
+def dilation(image_array: ImageArray, size: int = 5) -> ImageArray:
+    return cv2.dilate(image_array, np.ones((size, size), np.uint8), iterations=1)
+
+
+def erosion(image_array: ImageArray, size: int = 5) -> ImageArray:
+    return cv2.erode(image_array, np.ones((size, size), np.uint8), iterations=1)
+
+
+# Filter bank as a graph, every node is filter applied to output of other node
+# and halo of the filter (how far from pixel it reads), used for tiled execution.
+# Opening and closing reuse erosion and dilation computed for their own outputs.
+FilterNode = Tuple[Callable[[ImageArray], ImageArray], str, int]
+
+SOURCE = "image"
+
+FILTER_GRAPH: Dict[str, FilterNode] = {
+    # Linear Filters
+    "mean": (mean_filter, SOURCE, 1),
+    "gaussian": (gaussian, SOURCE, 4),  # truncated at 4 sigma
+    "median": (median, SOURCE, 1),
+    # Nonlinear Filters
+    "bilateral": (bilateral, SOURCE, 4),
+    "gaussian_blur": (gaussian_blur, SOURCE, 2),  # Gaussian Mixture Model Filter
+    "opening": (dilation, "erosion", 2),  # erosion then dilation
+    "closing": (erosion, "dilation", 2),  # dilation then erosion
+    "dilation": (dilation, SOURCE, 2),
+    "erosion": (erosion, SOURCE, 2),
+}
+
+FILTER_NAMES = list(FILTER_GRAPH)
+
+RunFilter = Callable[[Callable[[ImageArray], ImageArray], ImageArray, int], ImageArray]
+
+
+def filter_order(names: List[str]) -> List[str]:
+    # every node comes after the node it reads from
+    order: List[str] = []
+
+    def visit(name: str):
+        if name == SOURCE or name in order:
+            return
+        visit(FILTER_GRAPH[name][1])
+        order.append(name)
+
+    for name in names:
+        visit(name)
+
+    # nodes reading the same input go one after another,
+    # so tiled execution shares every input with workers once
+    def depth(name: str) -> int:
+        input = FILTER_GRAPH[name][1]
+        return 0 if input == SOURCE else depth(input) + 1
+
+    return sorted(order, key=depth)
+
+
+def run_filter_graph(
+    image_array: ImageArray, names: List[str], run: RunFilter
+) -> List[ImageArray]:
+    order = filter_order(names)
+
+    # intermediate result is dropped as soon as nothing else reads it
+    readers: Dict[str, int] = {name: names.count(name) for name in order}
+    for name in order:
+        input = FILTER_GRAPH[name][1]
+        if input != SOURCE:
+            readers[input] += 1
+
+    results: Dict[str, ImageArray] = {SOURCE: image_array}
+    outputs: Dict[str, ImageArray] = {}
+    for name in order:
+        image_filter, input, halo = FILTER_GRAPH[name]
+        with stage(name, pixels_count(results[input])):
+            results[name] = run(image_filter, results[input], halo)
+
+        if input != SOURCE:
+            readers[input] -= 1
+            if readers[input] == 0:
+                del results[input]
+
+        if name in names:
+            outputs[name] = results[name]
+
+    return [outputs[name] for name in names]
+
+
+def apply_filters(
+    image_array: ImageArray,
+    executor: TiledExecutor | None = None,
+    names: List[str] = FILTER_NAMES,
+) -> List[ImageArray]:
+    if executor is None or executor.workers <= 1:
+        return run_filter_graph(
+            image_array, names, lambda image_filter, array, _: image_filter(array)
+        )
+
+    # tiles of the image are filtered in parallel, output is the same,
+    # executor is reused for many images, so processes are started once
+    return run_filter_graph(image_array, names, executor.run)
 
 
 def estimate_distortion(
     initial_image_array: ImageArray, result_image_array: ImageArray
 ) -> float:
-    return np.sum(np.abs(result_image_array - initial_image_array)) / (128 * 128)
+    # sum of absolute differences of all channels per pixel
+    height, width = initial_image_array.shape[0], initial_image_array.shape[1]
+    channels = initial_image_array.size // (height * width)
+    return metrics.mae(initial_image_array, result_image_array) * channels
 
 
 def main():
-    img = Image.open("./images/lab-6/pigs-0.bmp").convert("RGB")
-    image_array = np.array(img)
+    parser = argparse.ArgumentParser(description="Noise and filters comparison.")
+    parser.add_argument(
+        "img_path",
+        nargs="?",
+        default="./images/lab-6/pigs-0.bmp",
+        help="Path to the image or raw frame (.npy).",
+    )
+    parser.add_argument(
+        "--output_dir",
+        default="./images/lab-6/",
+        help="Directory to save filtered images.",
+    )
+    parser.add_argument(
+        "--output_name", default="pigs", help="Name prefix of filtered images."
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["bmp", "npy"],
+        default="bmp",
+        help="Format of filtered images, npy is raw frame.",
+    )
+    parser.add_argument(
+        "--frames_dir",
+        help="Directory to keep noisy images as raw frames, they are read memory mapped.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=count_argument(0),
+        default=1,
+        help="Number of processes filtering tiles of image (0 means number of CPU cores).",
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args()
 
-    noisy_images: List[np.array] = [
-        image_array,
-        add_additive_noise(image_array, 20),
-        add_additive_noise(image_array, 50),
-        add_impulse_noise(image_array, amount=0.05),
-        add_impulse_noise(image_array, amount=0.1),
-        add_brightness_dependent_noise(image_array, base_variance=30),
-        add_brightness_dependent_noise(image_array, base_variance=60),
-        add_coordinate_dependent_noise(image_array, base_variance=30),
-        add_coordinate_dependent_noise(image_array, base_variance=60),
-    ]
+    with profiling(args), TiledExecutor(workers_count(args.workers)) as executor:
+        with stage("decode"):
+            image_array = load_pixels(args.img_path)
+
+        noisy_images: List[np.array] = [image_array]
+        if args.frames_dir is None:
+            noisy_images.extend(noise_variants(image_array, NOISES))
+        else:
+            # only views of mapped frames stay in memory
+            os.makedirs(args.frames_dir, exist_ok=True)
+            for i, noisy_image in enumerate(noise_variants(image_array, NOISES), 1):
+                path = os.path.join(
+                    args.frames_dir, f"{filename(args.img_path)}-noisy-{i}.npy"
+                )
+                noisy_images.append(read_frame(write_frame(path, noisy_image)))
 
-    filtered_images = apply_filters(noisy_images[1])
-    for index, image in enumerate(filtered_images):
-        if index == 0:
-            continue
+        filtered_images = apply_filters(noisy_images[1], executor)
+        for index, image in enumerate(filtered_images):
+            if index == 0:
+                continue
 
-        Image.fromarray(image).save(f"./images/lab-6/pigs-filtered-{index}.bmp")
+            save_pixels(
+                os.path.join(
+                    args.output_dir,
+                    f"{args.output_name}-filtered-{index}.{args.output_format}",
+                ),
+                image,
+            )
 
+        # tracemalloc can be already started by profiling
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        start = time.perf_counter()
 
-    for i, noisy_image in enumerate(noisy_images):
-        filtered_images = apply_filters(noisy_image)
+        for i, noisy_image in enumerate(noisy_images):
+            filtered_images = apply_filters(noisy_image, executor)
 
-        print("Distortion for image " + str(i))
-        for j, filtered_image in enumerate(filtered_images):
-            distortion = estimate_distortion(image_array, filtered_image)
-            print(distortion)
-        print()
+            print("Distortion for image " + str(i))
+            with stage("metrics", pixels_count(image_array) * len(filtered_images)):
+                scores = compare(image_array, filtered_images)
+            for filtered_image, score in zip(filtered_images, scores):
+                distortion = estimate_distortion(image_array, filtered_image)
+                print(f"{distortion} PSNR {score['psnr']:.2f} SSIM {score['ssim']:.4f}")
+            print()
 
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        print(
+            f"Filtered {len(noisy_images)} images with {len(FILTER_NAMES)} filters "
+            f"in {elapsed:.2f} s, peak memory {peak / 2**20:.1f} MiB"
+        )
 
 
 if __name__ == "__main__":
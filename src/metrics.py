@@ -0,0 +1,155 @@
+from typing import Dict, Iterator, List, Tuple
+import cv2
+import numpy as np
+
+# Image quality metrics of results against one reference.
+# Images are read in chunks of rows (with halo for SSIM window), so memory doesn't
+# depend on image size, and differences are computed in wide type, so uint8 doesn't wrap.
+# Every chunk of reference is prepared once and compared with all candidates.
+
+CHUNK_ROWS = 64
+
+METRICS = ("mae", "mse", "psnr", "ssim")
+
+# same constants as skimage.metrics.structural_similarity
+SSIM_WINDOW = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+Scores = Dict[str, float]
+
+
+def row_chunks(start: int, stop: int, chunk_rows: int) -> Iterator[Tuple[int, int]]:
+    for top in range(start, stop, chunk_rows):
+        yield top, min(top + chunk_rows, stop)
+
+
+def default_data_range(image: np.ndarray) -> float:
+    if not np.issubdtype(image.dtype, np.integer):
+        raise ValueError("Data range must be given for float images")
+    info = np.iinfo(image.dtype)
+    return float(info.max) - float(info.min)
+
+
+def difference(reference: np.ndarray, result: np.ndarray) -> np.ndarray:
+    if np.issubdtype(reference.dtype, np.integer) and np.issubdtype(
+        result.dtype, np.integer
+    ):
+        return np.subtract(result, reference, dtype=np.int64)
+    return np.subtract(result, reference, dtype=np.float64)
+
+
+def window_means(pixels: np.ndarray) -> np.ndarray:
+    # means of every 7x7 window, only centers with whole window inside are valid
+    return cv2.blur(pixels, (SSIM_WINDOW, SSIM_WINDOW), borderType=cv2.BORDER_REFLECT)
+
+
+def ssim_sums(
+    reference: np.ndarray,
+    candidates: List[np.ndarray],
+    data_range: float,
+    chunk_rows: int,
+) -> List[float]:
+    # skimage way: uniform window, sample covariance,
+    # mean over pixels far enough from border to have whole window
+    height, width = reference.shape[0], reference.shape[1]
+    pad = SSIM_WINDOW // 2
+    if height < SSIM_WINDOW or width < SSIM_WINDOW:
+        raise ValueError("Image is smaller than SSIM window")
+
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+    window_area = SSIM_WINDOW * SSIM_WINDOW
+    cov_norm = window_area / (window_area - 1)
+    inner = (slice(pad, -pad), slice(pad, width - pad))
+
+    sums = [0.0] * len(candidates)
+    for top, bottom in row_chunks(pad, height - pad, chunk_rows):
+        rows = slice(top - pad, bottom + pad)
+
+        x = reference[rows].astype(np.float64)
+        ux = window_means(x)[inner]
+        vx = cov_norm * (window_means(x * x)[inner] - ux * ux)
+
+        for i, candidate in enumerate(candidates):
+            y = candidate[rows].astype(np.float64)
+            uy = window_means(y)[inner]
+            vy = cov_norm * (window_means(y * y)[inner] - uy * uy)
+            vxy = cov_norm * (window_means(x * y)[inner] - ux * uy)
+
+            similarity = (2 * ux * uy + c1) * (2 * vxy + c2)
+            similarity /= (ux * ux + uy * uy + c1) * (vx + vy + c2)
+            sums[i] += float(similarity.sum())
+
+    return sums
+
+
+def compare(
+    reference: np.ndarray,
+    candidates: List[np.ndarray],
+    metrics: Tuple[str, ...] = METRICS,
+    data_range: float | None = None,
+    chunk_rows: int = CHUNK_ROWS,
+) -> List[Scores]:
+    for candidate in candidates:
+        if candidate.shape != reference.shape:
+            raise ValueError(
+                f"Shape {candidate.shape} differs from reference {reference.shape}"
+            )
+    if data_range is None:
+        data_range = default_data_range(reference)
+
+    height = reference.shape[0]
+    absolute_sums = [0.0] * len(candidates)
+    squared_sums = [0.0] * len(candidates)
+
+    if "mae" in metrics or "mse" in metrics or "psnr" in metrics:
+        for top, bottom in row_chunks(0, height, chunk_rows):
+            ref = reference[top:bottom]
+            for i, candidate in enumerate(candidates):
+                diff = difference(ref, candidate[top:bottom])
+                absolute_sums[i] += float(np.abs(diff).sum())
+                squared_sums[i] += float(np.square(diff).sum())
+
+    if "ssim" in metrics:
+        ssim_totals = ssim_sums(reference, candidates, data_range, chunk_rows)
+        pad = SSIM_WINDOW // 2
+        ssim_count = (
+            (reference.shape[0] - 2 * pad)
+            * (reference.shape[1] - 2 * pad)
+            * (reference.size // (reference.shape[0] * reference.shape[1]))
+        )
+
+    scores: List[Scores] = []
+    for i in range(len(candidates)):
+        mse = squared_sums[i] / reference.size
+        score = {
+            "mae": absolute_sums[i] / reference.size,
+            "mse": mse,
+            "psnr": float(np.log10(data_range**2 / mse) * 10) if mse > 0 else np.inf,
+        }
+        if "ssim" in metrics:
+            score["ssim"] = ssim_totals[i] / ssim_count
+        scores.append({metric: score[metric] for metric in metrics})
+
+    return scores
+
+
+def mae(reference: np.ndarray, result: np.ndarray) -> float:
+    return compare(reference, [result], ("mae",))[0]["mae"]
+
+
+def mse(reference: np.ndarray, result: np.ndarray) -> float:
+    return compare(reference, [result], ("mse",))[0]["mse"]
+
+
+def psnr(
+    reference: np.ndarray, result: np.ndarray, data_range: float | None = None
+) -> float:
+    return compare(reference, [result], ("psnr",), data_range)[0]["psnr"]
+
+
+def ssim(
+    reference: np.ndarray, result: np.ndarray, data_range: float | None = None
+) -> float:
+    return compare(reference, [result], ("ssim",), data_range)[0]["ssim"]
@@ -0,0 +1,157 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+from PIL import Image
+
+from decode import fit_size, plan_decode
+
+# Composes many images into one. The whole layout is computed first from image sizes
+# (for paths only headers are read), then the canvas is allocated once
+# and every source is decoded, resized and pasted straight into its place.
+
+# image or path to it, path is decoded only when its turn comes
+Source = Union[Image.Image, str]
+
+# left, top, width, height
+Placement = Tuple[int, int, int, int]
+
+Layout = Tuple[Tuple[int, int], List[Placement]]
+
+
+def source_size(source: Source) -> Tuple[int, int]:
+    if isinstance(source, str):
+        with Image.open(source) as img:
+            return img.size
+    return source.size
+
+
+def vertical_layout(sizes: List[Tuple[int, int]]) -> Layout:
+    # every image is scaled to the widest one
+    new_width = max(width for width, _ in sizes)
+
+    placements: List[Placement] = []
+    top = 0
+    for width, height in sizes:
+        if width != new_width:
+            height = round(height * (new_width / width))
+        placements.append((0, top, new_width, height))
+        top += height
+
+    return (new_width, top), placements
+
+
+def horizontal_layout(sizes: List[Tuple[int, int]]) -> Layout:
+    # every image is scaled to the highest one
+    new_height = max(height for _, height in sizes)
+
+    placements: List[Placement] = []
+    left = 0
+    for width, height in sizes:
+        if height != new_height:
+            width = round(width * (new_height / height))
+        placements.append((left, 0, width, new_height))
+        left += width
+
+    return (left, new_height), placements
+
+
+def columns_argument(value: str) -> int:
+    # argparse type of number of contact sheet columns
+    cols = int(value)
+    if cols < 1:
+        raise argparse.ArgumentTypeError(f"at least 1 column is needed, got {cols}")
+    return cols
+
+
+def grid_layout(
+    sizes: List[Tuple[int, int]],
+    cols: int,
+    cell_width: int,
+    cell_height: int,
+    gap: int = 0,
+) -> Layout:
+    # contact sheet, every image is fit into its cell and centered
+    if cols < 1:
+        raise ValueError(f"Contact sheet needs at least 1 column, got {cols}")
+    rows = (len(sizes) + cols - 1) // cols
+
+    placements: List[Placement] = []
+    for i, (width, height) in enumerate(sizes):
+        row, col = divmod(i, cols)
+        new_width, new_height = fit_size(width, height, cell_width, cell_height)
+        left = col * (cell_width + gap) + (cell_width - new_width) // 2
+        top = row * (cell_height + gap) + (cell_height - new_height) // 2
+        placements.append((left, top, new_width, new_height))
+
+    canvas_width = cols * cell_width + (cols - 1) * gap
+    canvas_height = rows * cell_height + (rows - 1) * gap
+    return (canvas_width, canvas_height), placements
+
+
+def placed(source: Source, placement: Placement) -> Image.Image:
+    _, _, width, height = placement
+
+    if isinstance(source, str):
+        img = plan_decode(Image.open(source), (width, height))
+        if img.size == (width, height):
+            img.load()
+            return img
+        return img.resize((width, height))
+
+    if source.size == (width, height):
+        return source
+    return source.resize((width, height))
+
+
+def compose(
+    sources: List[Source],
+    layout: Layout,
+    mode: str = "RGB",
+    background: int | Tuple[int, ...] = 0,
+    workers: int = 1,
+) -> Image.Image:
+    size, placements = layout
+    canvas = Image.new(mode, size, background)
+
+    def paste(img: Image.Image, placement: Placement):
+        left, top, _, _ = placement
+        canvas.paste(img, (left, top))
+
+    if workers <= 1:
+        for source, placement in zip(sources, placements):
+            paste(placed(source, placement), placement)
+        return canvas
+
+    # decoding and resizing release GIL, pasting is done in this thread
+    with ThreadPoolExecutor(workers) as pool:
+        imgs = pool.map(placed, sources, placements)
+        for img, placement in zip(imgs, placements):
+            paste(img, placement)
+
+    return canvas
+
+
+def mosaic(
+    sources: List[Source], direction: str = "vertical", workers: int = 1
+) -> Image.Image:
+    sizes = [source_size(source) for source in sources]
+    if direction == "vertical":
+        layout = vertical_layout(sizes)
+    else:
+        layout = horizontal_layout(sizes)
+
+    return compose(sources, layout, workers=workers)
+
+
+def contact_sheet(
+    sources: List[Source],
+    cols: int,
+    cell_width: int = 256,
+    cell_height: int = 256,
+    gap: int = 0,
+    background: Tuple[int, int, int] = (0, 0, 0),
+    workers: int = 1,
+) -> Image.Image:
+    sizes = [source_size(source) for source in sources]
+    layout = grid_layout(sizes, cols, cell_width, cell_height, gap)
+    return compose(sources, layout, background=background, workers=workers)
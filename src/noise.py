@@ -0,0 +1,181 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Deque, Dict, Iterator, List, NamedTuple, Tuple
+import numpy as np
+
+from profiling import stage
+
+# Generates noisy variants of an image for augmentation.
+# Noise is drawn in float32 chunks of rows into a reused buffer and written
+# straight into uint8 result, so only the result is allocated at full size.
+# Every variant gets its own random stream spawned from one seed, so results
+# are the same no matter how many workers are used and in which order they finish.
+
+CHUNK_ROWS = 256
+
+# how many impulse coordinates are drawn at once
+IMPULSE_BATCH = 1 << 16
+
+# std of gaussian noise for rows from top to bottom
+StdMap = Callable[[int, int], float | np.ndarray]
+
+
+class Noise(NamedTuple):
+    kind: str
+    args: Tuple
+
+
+def add_gaussian(
+    image: np.ndarray,
+    rng: np.random.Generator,
+    std: StdMap,
+    chunk_rows: int = CHUNK_ROWS,
+) -> np.ndarray:
+    noisy = np.empty_like(image)
+    buffer = np.empty((chunk_rows,) + image.shape[1:], dtype=np.float32)
+
+    for top in range(0, image.shape[0], chunk_rows):
+        bottom = min(top + chunk_rows, image.shape[0])
+        noise = buffer[: bottom - top]
+        rng.standard_normal(dtype=np.float32, out=noise)
+        noise *= std(top, bottom)
+        noise += image[top:bottom]
+        np.clip(noise, 0, 255, out=noise)
+        # assigning truncates, same as astype(np.uint8)
+        noisy[top:bottom] = noise
+
+    return noisy
+
+
+def additive(
+    image: np.ndarray, rng: np.random.Generator, variance: float
+) -> np.ndarray:
+    std = np.float32(variance**0.5)
+    return add_gaussian(image, rng, lambda top, bottom: std)
+
+
+def impulse(
+    image: np.ndarray,
+    rng: np.random.Generator,
+    amount: float = 0.05,
+    salt_vs_pepper: float = 0.5,
+) -> np.ndarray:
+    noisy = np.copy(image)
+    height, width = image.shape[0], image.shape[1]
+    num_salt = int(np.ceil(amount * image.size * salt_vs_pepper))
+    num_pepper = int(np.ceil(amount * image.size * (1 - salt_vs_pepper)))
+
+    # coordinates are drawn in batches, so they don't take more memory than image
+    for count, value in ((num_salt, 255), (num_pepper, 0)):
+        for start in range(0, count, IMPULSE_BATCH):
+            size = min(IMPULSE_BATCH, count - start)
+            rows = rng.integers(0, height, size, dtype=np.int32)
+            cols = rng.integers(0, width, size, dtype=np.int32)
+            noisy[rows, cols] = value
+
+    return noisy
+
+
+def brightness_dependent(
+    image: np.ndarray, rng: np.random.Generator, base_variance: float = 30
+) -> np.ndarray:
+    scale = np.float32(base_variance / 255.0)
+
+    def std(top: int, bottom: int) -> np.ndarray:
+        rows = image[top:bottom]
+        if rows.ndim == 2:
+            brightness = rows.astype(np.float32)
+        else:
+            brightness = rows.mean(axis=2, keepdims=True, dtype=np.float32)
+        brightness *= scale
+        return np.sqrt(brightness, out=brightness)
+
+    return add_gaussian(image, rng, std)
+
+
+def coordinate_dependent(
+    image: np.ndarray, rng: np.random.Generator, base_variance: float = 30
+) -> np.ndarray:
+    height, width = image.shape[0], image.shape[1]
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)
+    scale = np.float32(base_variance / 2)
+
+    def std(top: int, bottom: int) -> np.ndarray:
+        variance = (x[None, :] + y[top:bottom, None]) * scale
+        std = np.sqrt(variance, out=variance)
+        return std if image.ndim == 2 else std[..., None]
+
+    return add_gaussian(image, rng, std)
+
+
+NOISES: Dict[str, Callable[..., np.ndarray]] = {
+    "additive": additive,
+    "impulse": impulse,
+    "brightness_dependent": brightness_dependent,
+    "coordinate_dependent": coordinate_dependent,
+}
+
+
+def apply_noise(
+    image: np.ndarray, noise: Noise, seed: np.random.SeedSequence
+) -> np.ndarray:
+    with stage(f"noise_{noise.kind}", image.shape[0] * image.shape[1]):
+        return NOISES[noise.kind](image, np.random.default_rng(seed), *noise.args)
+
+
+def variant_seed(seed: np.random.SeedSequence, index: int) -> np.random.SeedSequence:
+    # same as seed.spawn(...)[index], without creating all children first
+    return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (index,))
+
+
+# image is sent to every worker once, not with every variant
+_worker_image: np.ndarray | None = None
+
+
+def _init_worker(image: np.ndarray):
+    global _worker_image
+    _worker_image = image
+
+
+def _worker_variant(noise: Noise, seed: np.random.SeedSequence) -> np.ndarray:
+    return apply_noise(_worker_image, noise, seed)
+
+
+def noise_variants(
+    image: np.ndarray,
+    noises: List[Noise],
+    count: int = 1,
+    seed: int | None = None,
+    workers: int = 1,
+    max_in_flight: int | None = None,
+) -> Iterator[np.ndarray]:
+    # count variants of every noise, in order of noises,
+    # variants are produced lazily and only few of them are held at once
+    root = np.random.SeedSequence(seed)
+    tasks = (
+        (noise, variant_seed(root, i * count + j))
+        for i, noise in enumerate(noises)
+        for j in range(count)
+    )
+
+    if workers <= 1:
+        for noise, variant in tasks:
+            yield apply_noise(image, noise, variant)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(image,)
+    ) as pool:
+        pending: Deque[Future] = deque()
+
+        for noise, variant in tasks:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(pool.submit(_worker_variant, noise, variant))
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
@@ -0,0 +1,167 @@
+import argparse
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Tuple
+from PIL import Image
+
+from batch import workers_count
+from profiling import stage
+
+# Output stage for processed images. Encoders release GIL, so images are encoded
+# in background threads while the next image is processed, only few images wait
+# for encoding at once. Every file is written under temporary name and renamed
+# when it's complete, so readers never see half written image.
+# Encoder options come from per-format presets, "default" is what Pillow does,
+# preset missing for a format falls back to default (JPEG has nothing faster).
+
+EncodeOptions = Dict[str, object]
+
+PRESETS: Dict[str, Dict[str, EncodeOptions]] = {
+    "PNG": {
+        "default": {},
+        "fast": {"compress_level": 1},
+        "small": {"optimize": True},
+    },
+    "JPEG": {
+        "default": {},
+        "small": {"quality": 75, "optimize": True, "progressive": True},
+        "high": {"quality": 95, "subsampling": "4:4:4"},
+    },
+    "WEBP": {
+        "default": {},
+        "fast": {"quality": 80, "method": 0},
+        "small": {"quality": 80, "method": 6},
+        "high": {"lossless": True},
+    },
+    "TIFF": {
+        "default": {},
+        "small": {"compression": "tiff_adobe_deflate"},
+    },
+}
+
+PRESET_NAMES = ("default", "fast", "small", "high")
+
+
+def add_output_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--preset",
+        choices=PRESET_NAMES,
+        default="default",
+        help="Encoder settings, formats without such preset use default.",
+    )
+    parser.add_argument(
+        "--encode_workers",
+        type=int,
+        default=1,
+        help="Number of threads encoding images in background (0 to encode in place).",
+    )
+
+
+def encode_options(format: str, preset: str = "default") -> EncodeOptions:
+    if preset not in PRESET_NAMES:
+        raise ValueError(f"Unknown encoder preset: {preset}")
+    return PRESETS.get(format.upper(), {}).get(preset, {})
+
+
+@contextmanager
+def atomic_path(path: str) -> Iterator[str]:
+    # file is written under temporary name next to the final one, then renamed,
+    # so the final path never holds partly written file
+    dir, name = os.path.split(path)
+    temp_path = os.path.join(dir, f".{name}.tmp-{os.getpid()}-{threading.get_ident()}")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def save_atomic(img: Image.Image, path: str, format: str, options: EncodeOptions):
+    with atomic_path(path) as temp_path:
+        with stage("encode", img.width * img.height):
+            img.save(temp_path, format, **options)
+
+
+class EncodeQueue:
+    def __init__(self, workers: int):
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending: Deque[Future] = deque()
+        self.max_pending = 2 * workers
+        # images can be submitted from several threads, for example tiles
+        self.lock = threading.Lock()
+
+    def submit(self, img: Image.Image, path: str, format: str, options: EncodeOptions):
+        # image must not be changed after it's submitted
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft().result()
+            self.pending.append(
+                self.pool.submit(save_atomic, img, path, format, options)
+            )
+
+    def wait(self):
+        with self.lock:
+            while len(self.pending) > 0:
+                self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown()
+
+
+# queue of this process, forked worker processes don't use queue of their parent
+_queue: Tuple[int, EncodeQueue] | None = None
+
+
+def active_queue() -> EncodeQueue | None:
+    if _queue is None or _queue[0] != os.getpid():
+        return None
+    return _queue[1]
+
+
+@contextmanager
+def encoding(workers: int) -> Iterator[None]:
+    # all images saved inside are written when it exits
+    global _queue
+    if workers <= 0 or active_queue() is not None:
+        yield
+        return
+
+    queue = EncodeQueue(workers)
+    _queue = (os.getpid(), queue)
+    try:
+        yield
+    finally:
+        _queue = None
+        queue.close()
+
+
+def batch_encoding(args: argparse.Namespace):
+    # in process pool images are already encoded in parallel by processes
+    if workers_count(args.workers) > 1:
+        return encoding(0)
+    return encoding(args.encode_workers)
+
+
+def save(img: Image.Image, path: str, format: str, preset: str = "default") -> str:
+    options = encode_options(format, preset)
+    queue = active_queue()
+    if queue is None:
+        save_atomic(img, path, format, options)
+    else:
+        queue.submit(img, path, format, options)
+    return path
+
+
+def flush():
+    # waits until every submitted image is written
+    queue = active_queue()
+    if queue is not None:
+        queue.wait()
@@ -0,0 +1,121 @@
+from typing import Callable, List, Tuple
+from PIL import Image
+import numpy as np
+
+# Point operation changes every pixel value independently, so it is just a table
+# of 256 values for every band. Tables of consecutive operations are composed,
+# then the whole chain is applied to the image in one pass.
+
+# receives source image and table composed so far, returns own table for every band
+PointOp = Callable[[Image.Image, np.ndarray], np.ndarray]
+
+VALUES = np.arange(256)
+
+COLOR_BANDS = ("R", "G", "B", "L")
+
+
+def identity(bands: Tuple[str, ...]) -> np.ndarray:
+    return np.tile(VALUES, (len(bands), 1))
+
+
+def to_table(values: np.ndarray) -> np.ndarray:
+    # same as Image.point does with values returned by function
+    return np.clip(np.round(values), 0, 255).astype(np.int64)
+
+
+def balance(red: float = 1.0, green: float = 1.0, blue: float = 1.0) -> PointOp:
+    factors = {"R": red, "G": green, "B": blue}
+
+    def op(img: Image.Image, lut: np.ndarray):
+        table = identity(img.getbands())
+        for i, band in enumerate(img.getbands()):
+            if band in factors:
+                table[i] = to_table(VALUES * factors[band])
+        return table
+
+    return op
+
+
+def threshold(value: int = 128) -> PointOp:
+    def op(img: Image.Image, lut: np.ndarray):
+        table = identity(img.getbands())
+        for i, band in enumerate(img.getbands()):
+            if band in COLOR_BANDS:
+                table[i] = np.where(VALUES > value, 255, 0)
+        return table
+
+    return op
+
+
+def negate() -> PointOp:
+    def op(img: Image.Image, lut: np.ndarray):
+        table = identity(img.getbands())
+        for i, band in enumerate(img.getbands()):
+            if band in COLOR_BANDS:
+                table[i] = 255 - VALUES
+        return table
+
+    return op
+
+
+def grayscale_mean(img: Image.Image, lut: np.ndarray) -> int:
+    # mean of grayscale image after previous operations, taken from rounded
+    # grayscale pixels just like ImageEnhance.Contrast does
+    if not np.array_equal(lut, identity(img.getbands())):
+        img = img.point(lut.flatten().tolist())
+    if img.mode != "L":
+        img = img.convert("L")
+
+    mean = float(np.dot(img.histogram(), VALUES)) / (img.width * img.height)
+    return int(mean + 0.5)
+
+
+def contrast(factor: float, mean: int | None = None) -> PointOp:
+    # same blending with gray image as ImageEnhance.Contrast,
+    # mean of the image can be provided when it's already known
+    def op(img: Image.Image, lut: np.ndarray):
+        gray = mean if mean is not None else grayscale_mean(img, lut)
+
+        blended = np.float32(gray) + np.float32(factor) * (VALUES - gray).astype(
+            np.float32
+        )
+        blended = np.clip(blended, 0, 255).astype(np.int64)
+
+        table = identity(img.getbands())
+        for i, band in enumerate(img.getbands()):
+            if band in COLOR_BANDS:
+                table[i] = blended
+        return table
+
+    return op
+
+
+def opacity(value: float) -> PointOp:
+    def op(img: Image.Image, lut: np.ndarray):
+        bands = img.getbands()
+        if "A" not in bands:
+            raise ValueError("Opacity requires image with alpha band")
+
+        table = identity(bands)
+        alpha = round(value * 255)
+        if 0 <= alpha <= 255:
+            table[bands.index("A")] = alpha
+        return table
+
+    return op
+
+
+def compose(img: Image.Image, ops: List[PointOp]) -> np.ndarray:
+    lut = identity(img.getbands())
+    for op in ops:
+        table = op(img, lut)
+        lut = np.take_along_axis(table, lut, axis=1)
+
+    return lut
+
+
+def apply_point_ops(
+    img: Image.Image, ops: List[PointOp], mode: str | None = None
+) -> Image.Image:
+    lut = compose(img, ops)
+    return img.point(lut.flatten().tolist(), mode)
@@ -0,0 +1,190 @@
+import argparse
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, TypeVar
+
+# Per-stage timing of lab CLIs, enabled with --profile.
+# Every stage (decode, mutation, filter, encode ...) records wall time, CPU time
+# of its thread, peak RSS of the process and pixels per second. Records are appended
+# as JSON lines to a file next to the trace, so stages done in worker processes
+# and encoder threads are collected too. When run ends, trace and summary are written.
+
+Record = Dict[str, object]
+
+Result = TypeVar("Result")
+
+# flags of add_profile_arguments by destination, they don't change outputs,
+# so cache keys leave them out
+PROFILE_ARGUMENTS: Dict[str, Dict[str, object]] = {
+    "profile": {
+        "nargs": "?",
+        "const": "profile.json",
+        "metavar": "TRACE",
+        "help": "Record time of every stage into JSON trace (default: profile.json) and print summary.",
+    },
+    "profile_cprofile": {
+        "metavar": "PATH",
+        "help": "Save cProfile stats of the main process, view them with pstats or snakeviz.",
+    },
+    "profile_tracemalloc": {
+        "type": int,
+        "metavar": "TOP",
+        "help": "Print TOP lines that allocated most memory in the main process.",
+    },
+}
+
+# file with records of the running profile, inherited by forked workers
+_stages_path: str | None = None
+_lock = threading.Lock()
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    for name, options in PROFILE_ARGUMENTS.items():
+        parser.add_argument(f"--{name}", **options)
+
+
+def peak_rss() -> int:
+    # bytes, Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_record(record: Record):
+    line = json.dumps(record) + "\n"
+    with _lock:
+        # short appended lines are not mixed up between processes
+        with open(_stages_path, "a") as file:
+            file.write(line)
+
+
+@contextmanager
+def stage(name: str, pixels: int = 0) -> Iterator[None]:
+    if _stages_path is None:
+        yield
+        return
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        write_record(
+            {
+                "name": name,
+                "pid": os.getpid(),
+                "start": time.time() - wall,
+                "wall": wall,
+                "cpu": time.thread_time() - start_cpu,
+                "peak_rss": peak_rss(),
+                "pixels": pixels,
+            }
+        )
+
+
+def read_records(path: str) -> List[Record]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip() != ""]
+
+
+def summarize(records: List[Record]) -> Dict[str, Record]:
+    summary: Dict[str, Record] = {}
+    for record in records:
+        total = summary.setdefault(
+            record["name"],
+            {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_rss": 0, "pixels": 0},
+        )
+        total["count"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        total["peak_rss"] = max(total["peak_rss"], record["peak_rss"])
+        total["pixels"] += record["pixels"]
+
+    for total in summary.values():
+        total["megapixels_per_second"] = (
+            total["pixels"] / 1_000_000 / total["wall"] if total["wall"] > 0 else 0.0
+        )
+    return summary
+
+
+def print_summary(summary: Dict[str, Record], wall: float):
+    print(f"Profile, total {wall:.3f} s")
+    print(
+        f"{'stage':<24}{'count':>7}{'wall s':>10}{'cpu s':>10}"
+        f"{'peak MiB':>10}{'MP/s':>10}"
+    )
+    for name, total in sorted(summary.items(), key=lambda item: -item[1]["wall"]):
+        print(
+            f"{name:<24}{total['count']:>7}{total['wall']:>10.3f}{total['cpu']:>10.3f}"
+            f"{total['peak_rss'] / 2**20:>10.1f}"
+            f"{total['megapixels_per_second']:>10.2f}"
+        )
+
+
+@contextmanager
+def profiling(args: argparse.Namespace) -> Iterator[None]:
+    # wraps main, does nothing without profile flags
+    global _stages_path
+
+    profiler: cProfile.Profile | None = None
+    if args.profile_cprofile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.profile_tracemalloc is not None:
+        tracemalloc.start()
+
+    if args.profile is not None:
+        _stages_path = f"{args.profile}.stages-{os.getpid()}"
+        if os.path.exists(_stages_path):
+            os.remove(_stages_path)
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_cprofile)
+
+        if args.profile_tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print(f"Top {args.profile_tracemalloc} allocations")
+            for statistic in snapshot.statistics("lineno")[: args.profile_tracemalloc]:
+                print(statistic)
+
+        if _stages_path is not None:
+            records = read_records(_stages_path)
+            if os.path.exists(_stages_path):
+                os.remove(_stages_path)
+            _stages_path = None
+
+            summary = summarize(records)
+            with open(args.profile, "w") as file:
+                json.dump(
+                    {"wall": wall, "stages": records, "summary": summary},
+                    file,
+                    indent=2,
+                )
+            print_summary(summary, wall)
+
+
+def pixels_count(img: object) -> int:
+    # PIL image or array of pixels
+    if hasattr(img, "shape"):
+        return img.shape[0] * img.shape[1]
+    return img.width * img.height
+
+
+def run_stage(name: str, func: Callable[..., Result], img: object, *args) -> Result:
+    with stage(name, pixels_count(img)):
+        return func(img, *args)
@@ -0,0 +1,161 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from typing import Callable, List, Tuple
+
+import output
+from profiling import PROFILE_ARGUMENTS
+
+# On disk cache of processed images. Key is hash of input file content together
+# with canonical description of everything done to it, so renamed or moved files
+# are still found and any change of flags or of the file itself is a miss.
+# Cached outputs are stored without image name and copied back under the new one.
+# When cache grows over its size, least recently used entries are removed.
+
+# changes when meaning of cached entries changes, so old entries are not used
+VERSION = 1
+
+BLOCK_SIZE = 1 << 20
+
+# arguments that don't change outputs, only where and how fast they are made
+RUN_ARGUMENTS = (
+    "imgs_paths",
+    "output_dir",
+    "workers",
+    "max_in_flight",
+    "tile_workers",
+    "cache_dir",
+    "cache_size",
+    "encode_workers",
+    *PROFILE_ARGUMENTS,
+)
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Directory for cache of processed images (default: no cache).",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=1024,
+        help="Max size of the cache in megabytes.",
+    )
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(BLOCK_SIZE):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_key(img_path: str, description: object) -> str:
+    # tuples and named tuples become lists, dict keys are sorted
+    canonical = json.dumps(
+        [VERSION, description], sort_keys=True, separators=(",", ":")
+    )
+    sha = hashlib.sha256(file_digest(img_path).encode())
+    sha.update(canonical.encode())
+    return sha.hexdigest()
+
+
+def entry_size(entry: str) -> int:
+    return sum(entry_file.stat().st_size for entry_file in os.scandir(entry))
+
+
+def restore(cache_dir: str, key: str, name: str, output_dir: str) -> List[str] | None:
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+
+    paths: List[str] = []
+    try:
+        for suffix in sorted(os.listdir(entry)):
+            path = os.path.join(output_dir, name + suffix)
+            with output.atomic_path(path) as temp_path:
+                shutil.copyfile(os.path.join(entry, suffix), temp_path)
+            paths.append(path)
+    except FileNotFoundError:
+        # evicted by other process meanwhile
+        return None
+
+    # entry was used, so it's the last to be evicted
+    os.utime(entry)
+    return paths
+
+
+def store(cache_dir: str, key: str, name: str, paths: List[str], max_bytes: int):
+    entry = os.path.join(cache_dir, key)
+    # copied under temporary name, so other processes never see half of the entry
+    temp_entry = f"{entry}.tmp-{os.getpid()}"
+    os.makedirs(temp_entry, exist_ok=True)
+
+    for path in paths:
+        # file is stored as what follows image name, for example "_0.png"
+        suffix = os.path.basename(path)[len(name) :]
+        shutil.copyfile(path, os.path.join(temp_entry, suffix))
+
+    try:
+        os.rename(temp_entry, entry)
+    except OSError:
+        # the same entry was stored by other process
+        shutil.rmtree(temp_entry, ignore_errors=True)
+
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir: str, max_bytes: int):
+    entries: List[Tuple[float, int, str]] = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and ".tmp-" not in entry.name:
+            try:
+                entries.append((entry.stat().st_mtime, entry_size(entry), entry.path))
+            except FileNotFoundError:
+                # evicted by other process meanwhile
+                continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def args_description(program: str, args: argparse.Namespace) -> object:
+    return {
+        "program": program,
+        **{key: value for key, value in vars(args).items() if key not in RUN_ARGUMENTS},
+    }
+
+
+def cached_outputs(
+    args: argparse.Namespace,
+    img_path: str,
+    description: object,
+    name: str,
+    output_dir: str,
+    produce: Callable[[], List[str]],
+) -> List[str]:
+    # produce processes the image and returns paths of saved outputs
+    if args.cache_dir is None:
+        return produce()
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    key = cache_key(img_path, description)
+
+    paths = restore(args.cache_dir, key, name, output_dir)
+    if paths is not None:
+        return paths
+
+    paths = produce()
+    # outputs can still be encoded in background
+    output.flush()
+    store(args.cache_dir, key, name, paths, args.cache_size * 2**20)
+    return paths
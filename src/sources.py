@@ -0,0 +1,60 @@
+from typing import Dict, Iterable, Iterator
+import glob
+import os
+import sys
+
+from helpers import filename
+
+# Expands CLI inputs into image paths one by one, so folders with thousands
+# of images are never listed or decoded all at once.
+# Input can be a file, a directory, a glob pattern or "-" to read paths from stdin.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".gif", ".webp")
+
+
+def is_image_path(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def directory_images(dir: str) -> Iterator[str]:
+    # sorted, so output order doesn't depend on file system
+    for name in sorted(os.listdir(dir)):
+        path = os.path.join(dir, name)
+        if os.path.isfile(path) and is_image_path(path):
+            yield path
+
+
+def stdin_paths() -> Iterator[str]:
+    for line in sys.stdin:
+        path = line.strip()
+        if path != "":
+            yield path
+
+
+def expand_paths(inputs: Iterable[str]) -> Iterator[str]:
+    for input in inputs:
+        if input == "-":
+            yield from stdin_paths()
+        elif os.path.isdir(input):
+            yield from directory_images(input)
+        elif glob.has_magic(input):
+            for path in sorted(glob.iglob(input)):
+                if os.path.isfile(path) and is_image_path(path):
+                    yield path
+        else:
+            yield input
+
+
+def unique_names(paths: Iterable[str]) -> Iterator[str]:
+    # outputs are named after input files without extension, so the same name
+    # from different folders would be written to one path, by parallel workers
+    # even at the same time; it fails before such path is processed
+    names: Dict[str, str] = {}
+    for path in paths:
+        name = filename(path)
+        if name in names:
+            raise ValueError(
+                f"{names[name]} and {path} would be saved under the same name: {name}"
+            )
+        names[name] = path
+        yield path
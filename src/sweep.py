@@ -0,0 +1,299 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+import tracemalloc
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Tuple
+import numpy as np
+from PIL import Image
+
+import lab_6
+from batch import add_batch_arguments, run_batch
+from frames import read_frame, write_frame
+from metrics import compare
+from noise import NOISES, Noise, apply_noise
+
+# python3 ./src/sweep.py ./images/lab-6/pigs-0.bmp --workers 0
+
+# Runs every noise of the grid against every filter and scores result against
+# the reference image. Noisy inputs are generated once and cached as .npy files,
+# workers memory map them. Every cell has a key made of everything its result
+# depends on, so a rerun computes only cells that are not in results file yet.
+# Finished cells are appended to .partial.jsonl as they complete, so cells of
+# interrupted run are not computed again.
+
+
+class FilterSpec(NamedTuple):
+    kind: str
+    args: Tuple
+
+
+FILTERS: Dict[str, Callable[..., np.ndarray]] = {
+    "mean": lab_6.mean_filter,
+    "gaussian": lab_6.gaussian,
+    "median": lab_6.median,
+    "bilateral": lab_6.bilateral,
+    "gaussian_blur": lab_6.gaussian_blur,
+    "opening": lab_6.opening,
+    "closing": lab_6.closing,
+    "dilation": lab_6.dilation,
+    "erosion": lab_6.erosion,
+}
+
+COLUMNS = [
+    "key",
+    "noise",
+    "noise_args",
+    "filter",
+    "filter_args",
+    "seed",
+    "distortion",
+    "mae",
+    "mse",
+    "psnr",
+    "ssim",
+    "seconds",
+    "peak_bytes",
+]
+
+Row = Dict[str, object]
+
+
+def digest(value: object) -> str:
+    text = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def array_digest(array: np.ndarray) -> str:
+    sha = hashlib.sha256(str((array.shape, array.dtype.str)).encode())
+    sha.update(np.ascontiguousarray(array).data)
+    return sha.hexdigest()
+
+
+def noise_key(image_key: str, noise: Noise, seed: int) -> str:
+    return digest([image_key, noise.kind, list(noise.args), seed])
+
+
+def cell_key(noisy_key: str, filter: FilterSpec) -> str:
+    return digest([noisy_key, filter.kind, list(filter.args)])
+
+
+def noise_seed(seed: int, key: str) -> np.random.SeedSequence:
+    # seed depends on the noise itself, not its place in the grid,
+    # so adding noises to the grid doesn't change others
+    return np.random.SeedSequence(seed, spawn_key=(int(key[:8], 16),))
+
+
+def cached_array(path: str, create: Callable[[], np.ndarray]) -> str:
+    if not os.path.exists(path):
+        write_frame(path, create())
+    return path
+
+
+def run_cell(cell: Tuple[str, str, FilterSpec], reference_path: str) -> Row:
+    key, noisy_path, filter = cell
+    reference = read_frame(reference_path)
+    noisy = read_frame(noisy_path)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    filtered = FILTERS[filter.kind](np.asarray(noisy), *filter.args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    scores = compare(reference, [filtered])[0]
+    return {
+        "key": key,
+        "filter": filter.kind,
+        "filter_args": list(filter.args),
+        "distortion": lab_6.estimate_distortion(reference, filtered),
+        **scores,
+        "seconds": seconds,
+        "peak_bytes": peak,
+    }
+
+
+def load_results(json_path: str, journal_path: str) -> Dict[str, Row]:
+    done: Dict[str, Row] = {}
+    if os.path.exists(json_path):
+        with open(json_path) as file:
+            done = {row["key"]: row for row in json.load(file)}
+
+    # cells finished by interrupted run
+    if os.path.exists(journal_path):
+        with open(journal_path) as file:
+            for line in file:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line can be cut when run is killed
+                    continue
+                done[row["key"]] = row
+
+    return done
+
+
+def append_result(journal_path: str, row: Row):
+    # every finished cell is kept right away, so interrupted sweep can continue
+    with open(journal_path, "a") as file:
+        file.write(json.dumps(row) + "\n")
+
+
+def save_results(rows: List[Row], json_path: str, csv_path: str):
+    with open(json_path, "w") as file:
+        json.dump(rows, file, indent=2)
+
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.DictWriter(file, COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {
+                    **row,
+                    "noise_args": " ".join(map(str, row["noise_args"])),
+                    "filter_args": " ".join(map(str, row["filter_args"])),
+                }
+            )
+
+
+def sweep(
+    img_path: str,
+    noises: List[Noise],
+    filters: List[FilterSpec],
+    seed: int,
+    output: str,
+    cache_dir: str,
+    workers: int = 1,
+    max_in_flight: int | None = None,
+) -> List[Row]:
+    os.makedirs(cache_dir, exist_ok=True)
+    reference = np.array(Image.open(img_path).convert("RGB"))
+    image_key = array_digest(reference)
+    reference_path = cached_array(
+        os.path.join(cache_dir, f"reference-{image_key}.npy"), lambda: reference
+    )
+
+    json_path = output + ".json"
+    csv_path = output + ".csv"
+    journal_path = output + ".partial.jsonl"
+    done = load_results(json_path, journal_path)
+
+    rows: List[Row] = []
+    cells: List[Tuple[str, str, FilterSpec]] = []
+    for noise in noises:
+        noisy_key = noise_key(image_key, noise, seed)
+        noisy_path = os.path.join(cache_dir, f"noisy-{noisy_key}.npy")
+
+        for filter in filters:
+            key = cell_key(noisy_key, filter)
+            rows.append(
+                {
+                    "key": key,
+                    "noise": noise.kind,
+                    "noise_args": list(noise.args),
+                    "seed": seed,
+                }
+            )
+            if key in done:
+                continue
+
+            # noisy input is made once for all filters and kept for next runs
+            cached_array(
+                noisy_path,
+                lambda: apply_noise(reference, noise, noise_seed(seed, noisy_key)),
+            )
+            cells.append((key, noisy_path, filter))
+
+    print(f"Computing {len(cells)} of {len(rows)} cells")
+    results = run_batch(
+        partial(run_cell, reference_path=reference_path),
+        cells,
+        workers,
+        max_in_flight,
+    )
+    for result in results:
+        append_result(journal_path, result)
+        done[result["key"]] = result
+
+    # results of cells that are not in the grid anymore are dropped
+    rows = [{**done[row["key"]], **row} for row in rows]
+    save_results(rows, json_path, csv_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    return rows
+
+
+def number(value: str) -> int | float:
+    return int(value) if value.lstrip("-").isdigit() else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Noise and filter parameter sweep.")
+    parser.add_argument("img_path", help="Path to the reference image.")
+    for kind in NOISES:
+        parser.add_argument(
+            f"--{kind}",
+            type=number,
+            nargs="+",
+            default=[],
+            help=f"Levels of {kind} noise.",
+        )
+    parser.add_argument(
+        "--filter",
+        nargs="+",
+        action="append",
+        metavar=("KIND", "ARGS"),
+        help="Filter and its parameters, can be repeated (default: all filters).",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of noise.")
+    parser.add_argument(
+        "--output",
+        default="./sweep/results",
+        help="Path of results without extension, .json and .csv are written.",
+    )
+    parser.add_argument(
+        "--cache_dir", default="./sweep/cache", help="Directory for noisy inputs."
+    )
+    add_batch_arguments(parser)
+    args = parser.parse_args()
+
+    noises = [Noise(kind, (level,)) for kind in NOISES for level in getattr(args, kind)]
+    if len(noises) == 0:
+        noises = lab_6.NOISES
+
+    if args.filter is None:
+        filters = [FilterSpec(kind, ()) for kind in FILTERS]
+    else:
+        filters = [
+            FilterSpec(kind, tuple(number(param) for param in params))
+            for kind, *params in args.filter
+        ]
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir != "":
+        os.makedirs(output_dir, exist_ok=True)
+
+    rows = sweep(
+        args.img_path,
+        noises,
+        filters,
+        args.seed,
+        args.output,
+        args.cache_dir,
+        args.workers,
+        args.max_in_flight,
+    )
+    for row in rows:
+        print(
+            f"{row['noise']} {row['noise_args']} {row['filter']} {row['filter_args']}: "
+            f"distortion {row['distortion']:.2f}, PSNR {row['psnr']:.2f}, "
+            f"SSIM {row['ssim']:.4f}, {row['seconds'] * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, List, Tuple
+import os
+import numpy as np
+
+# Runs window filters over overlapping tiles in a process pool.
+# Input and output frames live in shared memory, so workers don't copy whole images,
+# every tile is read with halo around it and only its inner part is written back.
+# Executor keeps its pool and the last shared input between runs, so filters
+# of the same image don't start processes or copy the image again.
+
+TileFilter = Callable[[np.ndarray], np.ndarray]
+
+# top, bottom, left, right
+Box = Tuple[int, int, int, int]
+
+
+def tile_boxes(height: int, width: int, tile_size: int) -> List[Box]:
+    boxes: List[Box] = []
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            bottom = min(top + tile_size, height)
+            right = min(left + tile_size, width)
+            boxes.append((top, bottom, left, right))
+
+    return boxes
+
+
+def with_halo(box: Box, halo: int, height: int, width: int) -> Box:
+    top, bottom, left, right = box
+    return (
+        max(top - halo, 0),
+        min(bottom + halo, height),
+        max(left - halo, 0),
+        min(right + halo, width),
+    )
+
+
+def filter_tile(func: TileFilter, source: np.ndarray, box: Box, halo: int):
+    height, width = source.shape[0], source.shape[1]
+    top, bottom, left, right = box
+    outer_top, outer_bottom, outer_left, outer_right = with_halo(
+        box, halo, height, width
+    )
+
+    result = func(source[outer_top:outer_bottom, outer_left:outer_right])
+
+    # dropping halo, on image edges there is no halo, so filter sees the same border
+    return result[
+        top - outer_top : bottom - outer_top, left - outer_left : right - outer_left
+    ]
+
+
+def _run_tile(
+    func: TileFilter,
+    input_name: str,
+    output_name: str,
+    shape: Tuple[int, ...],
+    dtype: str,
+    box: Box,
+    halo: int,
+):
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    try:
+        source = np.ndarray(shape, dtype=dtype, buffer=input_memory.buf)
+        output = np.ndarray(shape, dtype=dtype, buffer=output_memory.buf)
+
+        top, bottom, left, right = box
+        output[top:bottom, left:right] = filter_tile(func, source, box, halo)
+
+        del source, output
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+
+class TiledExecutor:
+    def __init__(self, workers: int | None = None, tile_size: int = 512):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.tile_size = tile_size
+        self.pool: ProcessPoolExecutor | None = None
+        # last input and its shared copy, filters reading the same array reuse it
+        self.input: Tuple[np.ndarray, shared_memory.SharedMemory] | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.release_input()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def release_input(self):
+        if self.input is not None:
+            _, input_memory = self.input
+            input_memory.close()
+            input_memory.unlink()
+            self.input = None
+
+    def shared_input(self, array: np.ndarray) -> shared_memory.SharedMemory:
+        # array is copied only when it's not the one shared last time,
+        # so it must not be changed between runs
+        if self.input is not None and self.input[0] is array:
+            return self.input[1]
+
+        self.release_input()
+        input_memory = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        source = np.ndarray(array.shape, dtype=array.dtype, buffer=input_memory.buf)
+        source[:] = array
+        del source
+
+        self.input = (array, input_memory)
+        return input_memory
+
+    def run(self, func: TileFilter, array: np.ndarray, halo: int) -> np.ndarray:
+        return self.run_many([(func, halo)], array)[0]
+
+    def run_many(
+        self, filters: List[Tuple[TileFilter, int]], array: np.ndarray
+    ) -> List[np.ndarray]:
+        # each filter is (function, halo), function must keep shape and dtype
+        # and be picklable (defined on module level)
+        height, width = array.shape[0], array.shape[1]
+        boxes = tile_boxes(height, width, self.tile_size)
+
+        # single core path is the plain full frame filter
+        if self.workers <= 1 or len(boxes) == 1:
+            return [func(array) for func, _ in filters]
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers)
+
+        input_memory = self.shared_input(array)
+        output_memories = [
+            shared_memory.SharedMemory(create=True, size=array.nbytes) for _ in filters
+        ]
+        try:
+            futures = [
+                self.pool.submit(
+                    _run_tile,
+                    func,
+                    input_memory.name,
+                    output_memory.name,
+                    array.shape,
+                    array.dtype.str,
+                    box,
+                    halo,
+                )
+                for (func, halo), output_memory in zip(filters, output_memories)
+                for box in boxes
+            ]
+            for future in futures:
+                future.result()
+
+            results: List[np.ndarray] = []
+            for output_memory in output_memories:
+                output = np.ndarray(
+                    array.shape, dtype=array.dtype, buffer=output_memory.buf
+                )
+                results.append(output.copy())
+                del output
+
+            return results
+        finally:
+            for output_memory in output_memories:
+                output_memory.close()
+                output_memory.unlink()
+
+
+def run_tiled(
+    func: TileFilter,
+    array: np.ndarray,
+    halo: int,
+    workers: int | None = None,
+    tile_size: int = 512,
+) -> np.ndarray:
+    with TiledExecutor(workers, tile_size) as executor:
+        return executor.run(func, array, halo)
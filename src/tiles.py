@@ -0,0 +1,68 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterator, List, Tuple
+from PIL import Image
+
+from helpers import save_img
+
+# Tiles are cropped from one image only when they are requested and are
+# encoded one by one (or few at once in parallel), so only few tiles exist
+# next to the image at once.
+
+# left, upper, right, lower
+TileBox = Tuple[int, int, int, int]
+
+
+def tile_boxes(width: int, height: int, cols: int, rows: int) -> List[TileBox]:
+    tile_width = width // cols
+    tile_height = height // rows
+
+    boxes: List[TileBox] = []
+    for i in range(rows):
+        for j in range(cols):
+            left = j * tile_width
+            upper = i * tile_height
+            # Adjust right and lower to not exceed image dimensions
+            right = min(left + tile_width, width)
+            lower = min(upper + tile_height, height)
+            boxes.append((left, upper, right, lower))
+
+    return boxes
+
+
+def split(img: Image.Image, cols: int, rows: int) -> Iterator[Image.Image]:
+    # every tile becomes separate image only when it is requested
+    for box in tile_boxes(img.width, img.height, cols, rows):
+        yield img.crop(box)
+
+
+def save_tiles(
+    img: Image.Image,
+    cols: int,
+    rows: int,
+    name: str,
+    dir: str,
+    workers: int = 1,
+    preset: str = "default",
+) -> List[str]:
+    # tiles are saved as name_0, name_1 ... row by row
+    tiles = enumerate(split(img, cols, rows))
+    paths: List[str] = []
+
+    if workers <= 1:
+        for i, tile in tiles:
+            paths.append(save_img(tile, f"{name}_{i}", dir, preset))
+        return paths
+
+    # encoder releases GIL, only few tiles are waiting for it at once
+    with ThreadPoolExecutor(workers) as pool:
+        pending: Deque[Future] = deque()
+        for i, tile in tiles:
+            if len(pending) >= 2 * workers:
+                paths.append(pending.popleft().result())
+            pending.append(pool.submit(save_img, tile, f"{name}_{i}", dir, preset))
+
+        while len(pending) > 0:
+            paths.append(pending.popleft().result())
+
+    return paths